@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+aggregator.py - Merge enter and leave counts from many track-inout sites
+
+Each tracker with SPOOL_ON = True in config.py posts gzip batches of
+crossing events to this node's /ingest url.  Events are deduplicated by
+their tracker, run and sequence number id, so a batch resent after a lost
+reply is only counted once.  Only the last id is kept per tracker since
+each tracker sends its events in order.  A batch from a run before the
+last one counted, or a different run with the same number, is refused
+with 409 and logged, since it means the tracker's run counter was reset.
+
+Counts are merged into hourly rollups per tracker.  Only the newest
+--keep-hours rollups are kept, so memory per site does not grow.
+New events of each batch are appended to a journal and synced to disk
+before the batch is acknowledged, since the tracker deletes its copy
+then.  State is saved to --state every --save-sec and the journal
+emptied.  At start the journal is replayed over the saved state, so a
+crash neither loses nor double counts events.
+
+    http://aggregator:8090/              combined view of all sites
+    http://aggregator:8090/rollups.json  hourly rollups per tracker
+
+How to Run
+
+    cd ~/track-inout
+    ./aggregator.py --port 8090
+    ./aggregator.py --port 8090 --stand-ins 200   # local load test
+
+"""
+PROG_VER = "ver 1.0"
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+
+PROG_NAME = os.path.basename(__file__)
+
+#------------------------------------------------------------------------------
+class RunWentBackwards(Exception):
+    """ A tracker sent a run number lower than or reusing one already counted """
+
+#------------------------------------------------------------------------------
+class JournalError(Exception):
+    """ A batch could not be written to the journal """
+
+#------------------------------------------------------------------------------
+class Rollups:
+    """ Hourly enter and leave rollups and last event id per tracker """
+    def __init__(self, keep_hours=168):
+        self.keep_hours = keep_hours
+        self.sites = {}      # tracker id: dict of name, last id, totals and buckets
+        self.lock = Lock()
+        self.changed = False
+        self.journal = None  # open journal file once load() has run
+
+    def site(self, tracker, name):
+        """ return the state dict for a tracker, creating it if new """
+        site = self.sites.get(tracker)
+        if site is None:
+            site = {"name": name, "run": 0, "run_key": "", "seq": 0,
+                    "enter": 0, "leave": 0,
+                    "occupancy": 0, "last_seen": 0.0,
+                    "buckets": {}}   # YYYYMMDDHH: [enter, leave]
+            self.sites[tracker] = site
+        return site
+
+    def new_events(self, events):
+        """
+        Return the events of a batch not counted yet.  Checks every event
+        before anything is merged so a bad batch changes nothing
+        """
+        last = {}   # tracker: last (run, seq, run key) including this batch
+        new = []
+        for event in events:
+            tracker = event["tracker"]
+            if tracker not in last:
+                site = self.sites.get(tracker, {"run": 0, "seq": 0,
+                                                "run_key": ""})
+                last[tracker] = (site["run"], site["seq"], site["run_key"])
+            last_run, last_seq, last_key = last[tracker]
+            if event["run"] < last_run or (event["run"] == last_run and
+                                           event["run_key"] != last_key):
+                raise RunWentBackwards("tracker %s %s sent run %i %s after "
+                                       "run %i %s"
+                                       % (tracker, event["site"], event["run"],
+                                          event["run_key"], last_run, last_key))
+            time.localtime(event["time"])   # bad times fail here
+            if event["direction"] not in ("enter", "leave"):
+                raise ValueError("Unknown direction %s" % event["direction"])
+            if (event["run"], event["seq"]) <= (last_run, last_seq):
+                continue   # already counted
+            last[tracker] = (event["run"], event["seq"], event["run_key"])
+            new.append(event)
+        return new
+
+    def merge(self, events):
+        """
+        Merge a batch of events in the order they were sent.
+        Returns the number of new events counted
+        """
+        with self.lock:
+            new = self.new_events(events)
+            if new and self.journal is not None:
+                # On disk before the reply, so an acknowledged event
+                # survives a crash
+                size = self.journal.tell()
+                try:
+                    self.journal.write("".join([json.dumps(event) + "\n"
+                                                for event in new]))
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                except (IOError, OSError) as err:
+                    try:
+                        self.journal.truncate(size)   # no half written lines
+                    except (IOError, OSError):
+                        pass
+                    raise JournalError(err)
+            for event in new:
+                site = self.site(event["tracker"], event["site"])
+                site["name"] = event["site"]
+                site["run"], site["seq"] = event["run"], event["seq"]
+                site["run_key"] = event["run_key"]
+                bucket = time.strftime("%Y%m%d%H",
+                                       time.localtime(event["time"]))
+                counts = site["buckets"].setdefault(bucket, [0, 0])
+                if event["direction"] == "enter":
+                    site["enter"] += 1
+                    counts[0] += 1
+                else:
+                    site["leave"] += 1
+                    counts[1] += 1
+                site["occupancy"] = event.get("occupancy", 0)
+                site["last_seen"] = time.time()
+                if len(site["buckets"]) > self.keep_hours:
+                    del site["buckets"][min(site["buckets"])]
+            if new:
+                self.changed = True
+        return len(new)
+
+    def combined(self):
+        """ return combined hourly [enter, leave] over all sites """
+        buckets = {}
+        with self.lock:
+            for site in self.sites.values():
+                for bucket, (enter, leave) in site["buckets"].items():
+                    counts = buckets.setdefault(bucket, [0, 0])
+                    counts[0] += enter
+                    counts[1] += leave
+        return buckets
+
+    def load(self, path):
+        """
+        Load saved state and replay the journal over it.  Events already
+        in the saved state are skipped as already counted
+        """
+        if os.path.exists(path):
+            with open(path) as f:
+                self.sites = json.load(f)
+            logging.info("Loaded %i trackers from %s", len(self.sites), path)
+        journal_path = path + ".journal"
+        if os.path.exists(journal_path):
+            events = []
+            with open(journal_path) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # Cut short by a crash so it was never acknowledged
+                        logging.warning("Skipped bad journal line")
+            logging.info("Replayed %i of %i journal events",
+                         self.merge(events), len(events))
+        self.journal = open(journal_path, "a")
+        self.save(path)
+
+    def save(self, path):
+        """
+        Save state if changed, then empty the journal.  Written to a temp
+        file then renamed.  Holds the lock so no event is journaled
+        between the state copy and emptying the journal
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.sites, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + ".tmp", path)
+            if self.journal is not None:
+                self.journal.seek(0)
+                self.journal.truncate()
+            self.changed = False
+
+#------------------------------------------------------------------------------
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    """ Handle each tracker connection on its own thread """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128   # hundreds of trackers may connect at once
+
+#------------------------------------------------------------------------------
+class AggregatorHandler(BaseHTTPRequestHandler):
+    """ Ingest event batches and serve the combined view """
+    rollups = None
+
+    def log_message(self, format, *args):
+        """ keep one line per request out of the console log """
+        return
+
+    def do_POST(self):
+        """ ingest a gzip or plain batch of JSON event lines """
+        if self.path != "/ingest":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+            events = [json.loads(line) for line in body.decode("utf-8").splitlines()
+                      if line.strip()]
+            added = self.rollups.merge(events)
+        except RunWentBackwards as err:
+            # Counting it would let later resends count twice and
+            # dropping it would lose the events, so the tracker keeps it
+            logging.error("Refused batch from %s: %s", self.client_address[0], err)
+            self.send_error(409, str(err))
+            return
+        except JournalError as err:
+            # Not on disk so not acknowledged.  The tracker sends it again
+            logging.error("Could not journal batch from %s: %s",
+                          self.client_address[0], err)
+            self.send_error(503)
+            return
+        except (IOError, ValueError, KeyError, TypeError) as err:
+            logging.warning("Bad batch from %s: %s", self.client_address[0], err)
+            self.send_error(400)
+            return
+        self.send_text(json.dumps({"received": len(events), "added": added}),
+                       "application/json")
+
+    def do_GET(self):
+        """ serve combined view or rollups """
+        if self.path == "/rollups.json":
+            with self.rollups.lock:
+                sites = json.dumps(self.rollups.sites)
+            self.send_text('{"sites": %s, "combined": %s}'
+                           % (sites, json.dumps(self.rollups.combined())),
+                           "application/json")
+        elif self.path == "/":
+            self.send_text(self.view(), "text/plain")
+        else:
+            self.send_error(404)
+
+    def view(self):
+        """ return a text table of each site and the combined totals """
+        hour = time.strftime("%Y%m%d%H")
+        lines = ["%s %s  %s" % (PROG_NAME, PROG_VER, time.strftime("%Y-%m-%d %H:%M:%S")),
+                 "",
+                 "%-20s %-12s %8s %8s %10s %10s %10s %10s" % ("Site", "Tracker",
+                     "Enter", "Leave", "Occupancy", "Hour Ent", "Hour Lve",
+                     "Last Sec")]
+        total = [0, 0, 0, 0, 0]
+        with self.rollups.lock:
+            trackers = sorted(self.rollups.sites,
+                              key=lambda t: (self.rollups.sites[t]["name"], t))
+            for tracker in trackers:
+                site = self.rollups.sites[tracker]
+                hour_enter, hour_leave = site["buckets"].get(hour, [0, 0])
+                row = [site["enter"], site["leave"], site["occupancy"],
+                       hour_enter, hour_leave]
+                total = [a + b for a, b in zip(total, row)]
+                lines.append("%-20s %-12s %8i %8i %10i %10i %10i %10i"
+                             % tuple([site["name"][:20], tracker[:12]] + row +
+                                     [time.time() - site["last_seen"]]))
+        lines.append("%-20s %-12s %8i %8i %10i %10i %10i"
+                     % tuple(["All Sites", ""] + total))
+        return "\n".join(lines) + "\n"
+
+    def send_text(self, text, content_type):
+        """ send a 200 reply """
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+#------------------------------------------------------------------------------
+def save_loop(rollups, path, interval):
+    """ save state every interval seconds """
+    while True:
+        time.sleep(interval)
+        try:
+            rollups.save(path)
+        except (IOError, OSError) as err:
+            logging.error("Could not save %s: %s", path, err)
+
+#------------------------------------------------------------------------------
+def start_stand_ins(count, port, folder, interval):
+    """
+    Start count stand-in trackers.  Each runs the real inout.EventSpool
+    with its own spool folder and publishes random crossing events
+    """
+    import inout
+    url = "http://localhost:%i/ingest" % port
+    for number in range(count):
+        bus = inout.EventBus()
+        name = "standin-%03i" % number
+        inout.EventSpool(bus, url=url, path=os.path.join(folder, name),
+                         site=name, batch_sec=5.0).start()
+        t = Thread(target=stand_in_loop, args=(bus, interval))
+        t.daemon = True
+        t.start()
+    print("Started %i stand-in trackers spooling to %s" % (count, folder))
+
+#------------------------------------------------------------------------------
+def stand_in_loop(bus, interval):
+    """ publish a crossing event about every interval seconds """
+    enter, leave = 0, 0
+    while True:
+        time.sleep(random.uniform(0.0, 2.0 * interval))
+        if random.random() < 0.5:
+            enter += 1
+            bus.publish("crossing", direction="enter", enter=enter, leave=leave,
+                        occupancy=max(0, enter - leave))
+        else:
+            leave += 1
+            bus.publish("crossing", direction="leave", enter=enter, leave=leave,
+                        occupancy=max(0, enter - leave))
+
+#------------------------------------------------------------------------------
+def main():
+    """ Run the aggregator web server """
+    parser = argparse.ArgumentParser(
+        description="Merge crossing events from many track-inout sites")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--state", default="aggregator-state.json",
+                        help="file to save rollups and last event ids")
+    parser.add_argument("--keep-hours", type=int, default=168,
+                        help="hourly rollups kept per site (default 168)")
+    parser.add_argument("--save-sec", type=float, default=10.0,
+                        help="seconds between state saves")
+    parser.add_argument("--stand-ins", type=int, default=0,
+                        help="start this many local stand-in trackers")
+    parser.add_argument("--stand-in-sec", type=float, default=2.0,
+                        help="average seconds between stand-in events")
+    parser.add_argument("--stand-in-path", default="media/stand-ins",
+                        help="spool folder for stand-in trackers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(funcName)-10s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    print("%s %s" % (PROG_NAME, PROG_VER))
+    rollups = Rollups(args.keep_hours)
+    rollups.load(args.state)
+    AggregatorHandler.rollups = rollups
+    server = ThreadedServer(("", args.port), AggregatorHandler)
+    t = Thread(target=save_loop, args=(rollups, args.state, args.save_sec))
+    t.daemon = True
+    t.start()
+    if args.stand_ins:
+        start_stand_ins(args.stand_ins, args.port, args.stand_in_path,
+                        args.stand_in_sec)
+    print("Combined view at http://localhost:%i/  ctrl-c to Quit" % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    rollups.save(args.state)
+    print("")
+    print("%s %s - Exiting" % (PROG_NAME, PROG_VER))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+backends.py - Frame processing backends for inout.py
+
+track() gets its gray, difference, blur, threshold and biggest blob
+steps from the backend named by BACKEND in config.py.
+
+    opencv  OpenCV 4 (or 3).  The one to run on a camera
+    numpy   Pure numpy reference.  Slow, but each step is written out
+            plainly so it can be checked by eye.  Used to test that
+            OpenCV results are right
+
+Every backend has the same methods.  Add a class and an entry in
+BACKENDS for a new one.
+
+Run this script for a per stage benchmark table of each backend and a
+check of its results against the numpy reference.
+
+How to Run
+
+    cd ~/track-inout
+    ./backends.py --resolutions 320x240,640x480 --frames 50
+
+"""
+PROG_VER = "ver 1.0"
+import argparse
+import os
+import time
+import numpy as np
+# Only needed for the opencv backend
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+PROG_NAME = os.path.basename(__file__)
+
+#------------------------------------------------------------------------------
+class OpenCVBackend:
+    """ Frame processing with OpenCV """
+    name = "opencv"
+
+    def gray(self, image):
+        """ return grayscale image. Gray frames are used as is """
+        if image.ndim == 2:
+            return image
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    def absdiff(self, image1, image2):
+        """ return absolute difference of two gray images """
+        return cv2.absdiff(image1, image2)
+
+    def blur(self, image, size):
+        """ return image averaged over size x size pixels """
+        return cv2.blur(image, (size, size))
+
+    def threshold(self, image, level):
+        """ return 255 where image is over level, else 0 """
+        return cv2.threshold(image, level, 255, cv2.THRESH_BINARY)[1]
+
+    def biggest_blob(self, thresholdimage, min_area):
+        """
+        Return (blob count, area, (x, y, w, h)) of the biggest blob with an
+        area over min_area.  Area and box are 0 and None if there is none
+        """
+        # findContours returns (image, contours, hierarchy) in OpenCV 3
+        # and (contours, hierarchy) in OpenCV 4
+        contours = cv2.findContours(thresholdimage, cv2.RETR_EXTERNAL,
+                                    cv2.CHAIN_APPROX_SIMPLE)[-2]
+        biggest_area, box = 0, None
+        for c in contours:
+            found_area = cv2.contourArea(c)
+            if found_area > min_area and found_area > biggest_area:
+                biggest_area = found_area
+                box = cv2.boundingRect(c)
+        return len(contours), biggest_area, box
+
+#------------------------------------------------------------------------------
+class NumpyBackend:
+    """
+    Pure numpy reference.  Follows OpenCV's rounding and border rules
+    so gray, difference, blur and threshold images match OpenCV.  Blob
+    area uses Pick's theorem on the blob pixels, which is the same as
+    OpenCV contourArea for solid blobs.  Holes are not filled in so areas
+    of blobs with holes are smaller.
+    """
+    name = "numpy"
+
+    def gray(self, image):
+        """
+        return grayscale image with OpenCV 4's 14 bit fixed point weights.
+        OpenCV 5 rounds a few pixels one level differently
+        """
+        if image.ndim == 2:
+            return image
+        b, g, r = [image[..., i].astype(np.int32) for i in range(3)]
+        return ((b * 1868 + g * 9617 + r * 4899 + 8192) >> 14).astype(np.uint8)
+
+    def absdiff(self, image1, image2):
+        """ return absolute difference of two gray images """
+        return np.abs(image1.astype(np.int16) - image2).astype(np.uint8)
+
+    def blur(self, image, size):
+        """ box filter using an integral image and mirrored borders """
+        before = size // 2   # OpenCV anchors the box at its center
+        after = size - 1 - before
+        # numpy reflect leaves out the edge pixel like OpenCV BORDER_REFLECT_101
+        padded = np.pad(image, ((before, after), (before, after)), mode="reflect")
+        integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), np.int64)
+        integral[1:, 1:] = padded.cumsum(0).cumsum(1)
+        height, width = image.shape
+        sums = (integral[size:size + height, size:size + width]
+                - integral[:height, size:size + width]
+                - integral[size:size + height, :width]
+                + integral[:height, :width])
+        # OpenCV rounds halves up
+        return ((sums + size * size // 2) // (size * size)).astype(np.uint8)
+
+    def threshold(self, image, level):
+        """ return 255 where image is over level, else 0 """
+        return np.where(image > level, 255, 0).astype(np.uint8)
+
+    def label(self, mask):
+        """
+        Return 8 connected blob labels for mask.  Each pixel starts with
+        its own index.  Neighbours take the smallest label around them
+        and labels then jump to their label's label until nothing changes
+        """
+        height, width = mask.shape
+        background = mask.size
+        labels = np.where(mask, np.arange(mask.size).reshape(mask.shape),
+                          background)
+        while True:
+            padded = np.pad(labels, 1, mode="constant",
+                            constant_values=background)
+            smallest = labels
+            for dy in range(3):
+                for dx in range(3):
+                    smallest = np.minimum(smallest,
+                                          padded[dy:dy + height, dx:dx + width])
+            smallest = np.where(mask, smallest, background)
+            flat = np.append(smallest.ravel(), background)
+            while True:
+                jumped = flat[flat]
+                if np.array_equal(jumped, flat):
+                    break
+                flat = jumped
+            smallest = flat[:-1].reshape(mask.shape)
+            if np.array_equal(smallest, labels):
+                return labels
+            labels = smallest
+
+    def biggest_blob(self, thresholdimage, min_area):
+        """
+        Return (blob count, area, (x, y, w, h)) of the biggest blob with an
+        area over min_area.  Area and box are 0 and None if there is none
+        """
+        mask = thresholdimage > 0
+        if not mask.any():
+            return 0, 0, None
+        labels = self.label(mask)
+        # Edge pixels have a background pixel above, below, left or right
+        padded = np.pad(mask, 1, mode="constant")
+        inside = (padded[:-2, 1:-1] & padded[2:, 1:-1] &
+                  padded[1:-1, :-2] & padded[1:-1, 2:])
+        ys, xs = np.nonzero(mask)
+        blobs, index = np.unique(labels[ys, xs], return_inverse=True)
+        pixels = np.bincount(index)
+        edges = np.bincount(index, weights=~inside[ys, xs])
+        # Pick's theorem gives the area of the polygon through edge pixel centers
+        areas = np.clip(pixels - edges / 2.0 - 1.0, 0, None)
+        biggest = int(np.argmax(areas))
+        if areas[biggest] <= min_area:
+            return len(blobs), 0, None
+        blob_ys, blob_xs = ys[index == biggest], xs[index == biggest]
+        x, y = int(blob_xs.min()), int(blob_ys.min())
+        box = (x, y, int(blob_xs.max()) - x + 1, int(blob_ys.max()) - y + 1)
+        return len(blobs), float(areas[biggest]), box
+
+# Backends by BACKEND config name.  OpenCV is left out if it is not installed
+BACKENDS = {"numpy": NumpyBackend}
+if cv2 is not None:
+    BACKENDS["opencv"] = OpenCVBackend
+
+#------------------------------------------------------------------------------
+def get_backend(name):
+    """ return a backend object for a BACKEND name """
+    if name not in BACKENDS:
+        raise ValueError("Unknown BACKEND %s. Choose from %s"
+                         % (name, ", ".join(sorted(BACKENDS))))
+    return BACKENDS[name]()
+
+#------------------------------------------------------------------------------
+def test_frames(width, height, count, seed=0):
+    """ return count BGR frames of textured blobs moving over a noisy background """
+    rng = np.random.RandomState(seed)
+    size = height // 4
+    texture = rng.randint(120, 256, (size, size, 3))
+    frames = []
+    for number in range(count):
+        image = rng.normal(90.0, 4.0, (height, width, 3))
+        for lane, speed in ((height // 8, 5), (height // 2, -7)):
+            x = (number * speed) % (width + size) - size
+            x1, x2 = max(0, x), min(width, x + size)
+            if x1 < x2:
+                image[lane:lane + size, x1:x2] = texture[:, x1 - x:x2 - x]
+        frames.append(np.clip(image, 0, 255).astype(np.uint8))
+    return frames
+
+#------------------------------------------------------------------------------
+def run_stages(backend, frames, blur_size, threshold, min_area, reference=None):
+    """
+    Run each stage over frames and return milliseconds per frame for
+    each stage.  With a reference backend, each stage is also run by the
+    reference on the same input.  Also returns the largest pixel
+    difference and the number of frames with a different blob box
+    """
+    stages = ("gray", "diff", "blur", "thresh", "blob")
+    seconds = dict((stage, 0.0) for stage in stages)
+    worst, boxes = 0, 0
+    gray1 = backend.gray(frames[0])
+    for image in frames[1:]:
+        start = time.time()
+        gray2 = backend.gray(image)
+        seconds["gray"] += time.time() - start
+        start = time.time()
+        difference_image = backend.absdiff(gray1, gray2)
+        seconds["diff"] += time.time() - start
+        start = time.time()
+        blurred = backend.blur(difference_image, blur_size)
+        seconds["blur"] += time.time() - start
+        start = time.time()
+        thresholdimage = backend.threshold(blurred, threshold)
+        seconds["thresh"] += time.time() - start
+        start = time.time()
+        blob = backend.biggest_blob(thresholdimage, min_area)
+        seconds["blob"] += time.time() - start
+        if reference is not None:
+            for result, expected in (
+                    (gray2, reference.gray(image)),
+                    (difference_image, reference.absdiff(gray1, gray2)),
+                    (blurred, reference.blur(difference_image, blur_size)),
+                    (thresholdimage, reference.threshold(blurred, threshold))):
+                worst = max(worst, int(np.abs(result.astype(np.int16)
+                                              - expected).max()))
+            if blob[2] != reference.biggest_blob(thresholdimage, min_area)[2]:
+                boxes += 1
+        gray1 = gray2
+    count = float(len(frames) - 1)
+    return (dict((stage, 1000.0 * seconds[stage] / count) for stage in stages),
+            worst, boxes)
+
+#------------------------------------------------------------------------------
+def main():
+    """ Benchmark each backend and check it against the numpy reference """
+    parser = argparse.ArgumentParser(
+        description="Benchmark and check inout.py frame processing backends")
+    parser.add_argument("--resolutions", default="320x240",
+                        help="comma separated WxH list (default 320x240)")
+    parser.add_argument("--backends", default=",".join(sorted(BACKENDS)),
+                        help="comma separated backend names")
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--blur", type=int, default=10)
+    parser.add_argument("--threshold", type=int, default=25)
+    parser.add_argument("--min-area", type=int, default=700)
+    args = parser.parse_args()
+
+    print("%s %s" % (PROG_NAME, PROG_VER))
+    print("ms per frame for each stage. MaxDiff is the largest pixel difference")
+    print("from the numpy reference given the same input to each stage and")
+    print("BoxDiff the frames with a different biggest blob box")
+    header = ("Backend", "Resolution", "Gray", "Diff", "Blur", "Thresh",
+              "Blob", "Total", "FPS", "MaxDiff", "BoxDiff")
+    print("%-8s %-10s %7s %7s %7s %7s %7s %8s %8s %7s %7s" % header)
+    reference = NumpyBackend()
+    for resolution in args.resolutions.split(","):
+        width, height = [int(value) for value in resolution.split("x")]
+        frames = test_frames(width, height, args.frames)
+        for name in args.backends.split(","):
+            backend = get_backend(name)
+            ms, worst, boxes = run_stages(
+                backend, frames, args.blur, args.threshold, args.min_area,
+                None if name == reference.name else reference)
+            total = sum(ms.values())
+            print("%-8s %-10s %7.3f %7.3f %7.3f %7.3f %7.3f %8.3f %8.1f %7i %7i"
+                  % (name, resolution, ms["gray"], ms["diff"], ms["blur"],
+                     ms["thresh"], ms["blob"], total, 1000.0 / total,
+                     worst, boxes))
+
+if __name__ == '__main__':
+    main()
@@ -17,12 +17,42 @@ MOVE_LIST_TIMEOUT = 0.5  # wait seconds with no motion then clear movelist
 SAVE_LOG = False        # Send console log messages to a log file instead of screen
 SAVE_CSV_FILE = False   # save CSV data file
 SAVE_IMAGES = True      # save image when leave or enter activated
+JPEG_CAPTURE_ON = False # True= save camera MJPEG frame as is when SAVE_IMAGES. Runs a second camera encoder for every frame  False= encode with opencv per event
+JPEG_QUALITY = 90       # jpeg quality 1-100 for opencv encoding and PiCamera MJPEG
 SHOW_MOVES = False      # show detailed x,y tracking movement data
 SHOW_FPS = False        # Show Frames per second
 
+# Occupancy Settings
+OCCUPANCY_RESET_TIMES = ["23:59"]  # list of "HH:MM" times to reset occupancy to zero eg closing time. [] = Never
+OCCUPANCY_LEARN_RATE = 0.1  # 0.0=off  weight of each reset when learning the drift correction per event
+OCCUPANCY_MAX = 0           # 0=off  log a warning when occupancy estimate is over this limit
+
+# Event Stream Settings
+EVENT_SOCKET_ON = False   # True= publish crossing, track and health events on EVENT_SOCKET_PATH
+EVENT_SOCKET_PATH = "/tmp/inout-events.sock"  # Unix socket. webserver.py relays events at /events
+EVENT_QUEUE_SIZE = 100    # events buffered per subscriber before a slow subscriber is dropped
+
+# Aggregator Settings
+SPOOL_ON = False           # True= send crossing events to an aggregator.py node at SPOOL_URL
+SPOOL_URL = "http://localhost:8090/ingest"  # aggregator.py ingest url
+SPOOL_PATH = "media/spool" # Folder for events waiting to be sent (rel or abs)
+SITE_NAME = ""             # name of this tracker on the aggregator. "" = host name
+SPOOL_BATCH_EVENTS = 100   # max events sent in one batch
+SPOOL_BATCH_SEC = 30.0     # seconds before a part full batch is sent
+SPOOL_RETRY_MAX = 60.0     # max seconds between retries while aggregator is unreachable
+
+# Session Recording Settings
+RECORD_ON = False          # True= record frames track() processes for exact replay with replay.py
+RECORD_PATH = "media/recordings"  # Folder for recording chunk files (rel or abs)
+RECORD_GRAY = True         # True= record grayscale frames  False= record color frames
+RECORD_SCALE = 1.0         # 1.0= full size for bit exact replay. eg 0.5 halves width and height
+RECORD_CHUNK_FRAMES = 250  # frames per chunk file. Larger chunks mean fewer, larger writes
+RECORD_MAX_MB = 500        # oldest chunk files are deleted when RECORD_PATH is over this size
+
 # Camera Settings
 # ---------------
 WEBCAM = False        # default = False False=PiCamera True=USB WebCamera
+GRAY_CAPTURE_ON = False  # True= capture grayscale (luma) frames only. Saves color conversion on slow RPI
 
 # Web Camera Settings
 WEBCAM_SRC = 0        # default = 0   USB opencv connection number
@@ -39,8 +69,17 @@ CAMERA_VFLIP = False  # True=flip camera image vertically
 CAMERA_ROTATION = 0   # Rotate camera image valid values 0, 90, 180, 270
 CAMERA_FRAMERATE = 25 # default = 25 lower for USB Web Cam. Try different settings
 
+# Stream Health Settings
+STREAM_READY_FRAMES = 3      # consecutive good frames before tracking starts
+STREAM_READY_TIMEOUT = 10.0  # seconds to wait for ready frames from a (re)started camera
+STREAM_STALL_TIMEOUT = 5.0   # seconds without a new frame before stream is restarted
+STREAM_RETRY_MIN = 0.5       # seconds first reconnect delay, doubles after each failure
+STREAM_RETRY_MAX = 30.0      # seconds maximum reconnect delay
+STREAM_STOP_TIMEOUT = 2.0    # seconds to wait for a stopped camera thread before reopening the camera
+
 # OpenCV Settings
 # ---------------
+BACKEND = "opencv"        # frame processing backend "opencv" or "numpy" (slow reference). See backends.py
 MIN_AREA = 700            # excludes all contours less than or equal to this Area
 DIFF_WINDOW_ON = False    # Show OpenCV image difference window
 THRESH_WINDOW_ON = False  # Show OpenCV image Threshold window
@@ -51,15 +90,24 @@ FONT_SCALE = .5           # size opencv text
 WINDOW_BIGGER = 2   # Resize multiplier for Movement Status Window
                     # if gui_window_on=True then makes opencv window bigger
                     # Note if the window is larger than 1 then a reduced frame rate will occur
+DISPLAY_FPS = 10    # max frames per second drawn for the window and MJPEG view. Tracking fps is not limited
+DISPLAY_MJPEG_ON = False  # True= serve the window view as MJPEG at http://<ip>:DISPLAY_MJPEG_PORT/
+DISPLAY_MJPEG_PORT = 8081
 THRESHOLD_SENSITIVITY = 25
 BLUR_SIZE = 10
+FLOW_CONFIRM_ON = False   # True= check each crossing with optical flow inside the blob. Rejects blob merge errors
+FLOW_MAX_POINTS = 50      # max corners tracked in the blob for FLOW_CONFIRM_ON
+FLOW_MIN_POINTS = 5       # fewer moving corners than this and the crossing is counted as is
+FLOW_MIN_AGREE = 0.3      # reject crossing if less than this fraction of moving corners agree
 
 # When variable DEVICE_CONTROL_ON = True
 # Use these settings if you wish to use the Device Control Option
 # Stop Light and Gate controlled by servo
 
+DEVICE_SIMULATE = False  # True= log servo and LED changes instead of using RPi.GPIO
+
 # LED control variables
-LIGHT_TIMER = 60
+LIGHT_TIMER = 60  # seconds minimum between gate changes
 LED_GREEN_PIN = 11
 LED_RED_PIN = 13
 
@@ -69,6 +117,7 @@ SERVO_FREQ = 50  # Set Frequency for servo control
 SERVO_0 = 2.5  # Set Duty Cycle for Servo at 0 degrees
 SERVO_90 = 7.5  #  Set Duty Cycle for 90 Degrees
 SERVO_180 = 12.5  # Set Duty Cycle for 180 Degrees
+SERVO_MOVE_TIME = 1.0  # seconds allowed for servo to move before lights change
 
 #======================================
 #       webserver.py Settings
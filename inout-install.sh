@@ -39,6 +39,12 @@ if [ $? -ne 0 ] ;  then
   wget -O config-240.py https://raw.githubusercontent.com/pageauc/track-inout/master/config-240.py
   wget -O Readme.md https://raw.githubusercontent.com/pageauc/track-inout/master/Readme.md
   wget -O webserver.py https://raw.githubusercontent.com/pageauc/track-inout/master/webserver.py
+  wget -O backends.py https://raw.githubusercontent.com/pageauc/track-inout/master/backends.py
+  wget -O report.py https://raw.githubusercontent.com/pageauc/track-inout/master/report.py
+  wget -O replay.py https://raw.githubusercontent.com/pageauc/track-inout/master/replay.py
+  wget -O synthetic.py https://raw.githubusercontent.com/pageauc/track-inout/master/synthetic.py
+  wget -O tuner.py https://raw.githubusercontent.com/pageauc/track-inout/master/tuner.py
+  wget -O aggregator.py https://raw.githubusercontent.com/pageauc/track-inout/master/aggregator.py
   wget -O webserver.sh https://raw.githubusercontent.com/pageauc/track-inout/master/webserver.sh
   wget -O media/webserver.txt https://raw.githubusercontent.com/pageauc/track-inout/master/webserver.txt
 else
@@ -47,6 +53,12 @@ else
   wget -O config-240.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/config-240.py
   wget -O Readme.md -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/Readme.md
   wget -O webserver.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/webserver.py
+  wget -O backends.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/backends.py
+  wget -O report.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/report.py
+  wget -O replay.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/replay.py
+  wget -O synthetic.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/synthetic.py
+  wget -O tuner.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/tuner.py
+  wget -O aggregator.py -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/aggregator.py
   wget -O webserver.sh -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/webserver.sh
   wget -O media/webserver.txt -q --show-progress https://raw.githubusercontent.com/pageauc/track-inout/master/webserver.txt
 fi
@@ -83,7 +95,7 @@ fi
 echo "------------------------------------------------"
 echo ""
 echo "5 - Installing track-inout Dependencies"
-sudo apt-get install -y python-opencv python-picamera dos2unix
+sudo apt-get install -y python3-opencv python3-picamera python3-numpy dos2unix
 dos2unix *
 echo "Done Dependencies"
 cd $DIR
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 track-inout  written by Claude Pageau pageauc@gmail.com
 Windows, Unix, Raspberry (Pi) - python opencv2 motion tracking
@@ -30,17 +30,26 @@ How to Run
     ./inout.py
 
 """
-from __future__ import print_function
-
+import time
+PROG_START = time.time()  # used to report time to first processed frame
 PROG_VER = "ver 1.3"
 print("Loading ...")
 # import python libraries
 import logging
 import os
-import time
 import datetime
-from threading import Thread
+import gzip
+import heapq
+import io
+import json
+import queue
+import socket
+import struct
+import uuid
+from threading import Thread, Condition, Event, Lock, current_thread
 import cv2
+import numpy as np
+import backends
 
 # Find the full path of this python script
 PROG_PATH = os.path.abspath(__file__)
@@ -76,23 +85,14 @@ CONFIG_FILE_PATH = BASE_DIR + "config.py"
 if not os.path.exists(CONFIG_FILE_PATH):
     print("ERROR - Missing config.py file - Could not find Configuration file %s"
           % (CONFIG_FILE_PATH))
-    import urllib2
-    CONFIG_URL = "https://raw.github.com/pageauc/motion-track/master/config.py"
-    print("Attempting to Download new config.py file")
-    print("from %s" % CONFIG_URL)
-    try:
-        WGET_FILE = urllib2.urlopen(CONFIG_URL)
-    except:
-        print("ERROR - Download of config.py Failed")
-        print("   Try Rerunning the motion-track-install.sh Again.")
-        print("   or")
-        print("   Perform GitHub curl install per Readme.md")
-        print("   and Try Again")
-        print("Exiting %s" % PROG_NAME)
-        quit(1)
-    f = open('config.py', 'wb')
-    f.write(WGET_FILE.read())
-    f.close()
+    # Note config.py is not downloaded here so a missing file never
+    # delays startup on a network timeout.
+    print("   Try Rerunning the inout-install.sh Again.")
+    print("   or")
+    print("   Perform GitHub curl install per Readme.md")
+    print("   and Try Again")
+    print("Exiting %s" % PROG_NAME)
+    quit(1)
 
 # Read Configuration variables from config.py file
 try:
@@ -101,12 +101,14 @@ except ImportError:
     print("ERROR - Problem importing %s" % CONFIG_FILE_PATH)
     quit(1)
 
-# Bypass loading picamera library if not available eg. UNIX or WINDOWS
-try:
-    from picamera.array import PiRGBArray
-    from picamera import PiCamera
-except ImportError:
-    WEBCAM = True
+# Only load picamera library if needed.
+# Bypass loading if not available eg. UNIX or WINDOWS
+if not WEBCAM:
+    try:
+        from picamera.array import PiRGBArray
+        from picamera import PiCamera
+    except ImportError:
+        WEBCAM = True
 
 if VERBOSE:
     print("Logging to Console per Variable VERBOSE=True")
@@ -132,86 +134,219 @@ if not os.path.isdir(IMAGE_PATH):
 
 # Get center line for movement counting
 if WEBCAM:
-    X_CENTER = WEBCAM_WIDTH/2
-    Y_CENTER = WEBCAM_HEIGHT/2
+    X_CENTER = WEBCAM_WIDTH // 2
+    Y_CENTER = WEBCAM_HEIGHT // 2
     X_MAX = WEBCAM_WIDTH
     Y_MAX = WEBCAM_HEIGHT
-    X_BUF = int(WEBCAM_WIDTH/BUFFER_SETTING)
-    Y_BUF = int(WEBCAM_HEIGHT/BUFFER_SETTING)
+    X_BUF = WEBCAM_WIDTH // BUFFER_SETTING
+    Y_BUF = WEBCAM_HEIGHT // BUFFER_SETTING
 else:
-    X_CENTER = CAMERA_WIDTH/2
-    Y_CENTER = CAMERA_HEIGHT/2
-    X_MAX = CAMERA_HEIGHT
-    Y_MAX = CAMERA_WIDTH
-    X_BUF = int(CAMERA_WIDTH/BUFFER_SETTING)
-    Y_BUF = int(CAMERA_HEIGHT/BUFFER_SETTING)
-
-# Setup GPIO for a Servo. Customize pin and Freq per variables
-if  DEVICE_CONTROL_ON:
+    X_CENTER = CAMERA_WIDTH // 2
+    Y_CENTER = CAMERA_HEIGHT // 2
+    X_MAX = CAMERA_WIDTH
+    Y_MAX = CAMERA_HEIGHT
+    X_BUF = CAMERA_WIDTH // BUFFER_SETTING
+    Y_BUF = CAMERA_HEIGHT // BUFFER_SETTING
+
+# Frame processing steps for track(). See backends.py
+try:
+    backend = backends.get_backend(BACKEND)
+except ValueError as err:
+    print("ERROR - %s" % err)
+    quit(1)
+
+# Load GPIO library for a Servo and LEDs only if needed.
+if DEVICE_CONTROL_ON and not DEVICE_SIMULATE:
     # IMPORTANT - You need to setup a servo and LED's on appropriate
     # GPIO pins.  This is sample code only.
     try:
         import RPi.GPIO as GPIO
     except ImportError:
         print("ERROR - Problem importing RPi.GPIO library")
+        print("        Set DEVICE_SIMULATE = True to run without GPIO")
         quit(1)
-    # Initialize servo pwm and led status
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setwarnings(False)
-    GPIO.setup(SERVO_PIN, GPIO.OUT)
-    p = GPIO.PWM(SERVO_PIN, SERVO_FREQ)
-    GPIO.setup(LED_RED_PIN, GPIO.OUT)
-    GPIO.setup(LED_GREEN_PIN, GPIO.OUT)
-    # Setup LED Status
-    GPIO.output(LED_GREEN_PIN, GPIO.HIGH) # Green LED on
-    GPIO.output(LED_RED_PIN, GPIO.LOW)    # Red LED Off
-    logging.info("Light is GREEN")
-    # Setup Servo Status
-    p.start(SERVO_90)    # Set servo in Neutral 90 Position
-    logging.info("Servo is Open at 90")
 
 #------------------------------------------------------------------------------
-def led_green(green_on):
-    """ Set green and red leds based on servo position """
-    if green_on:
-        GPIO.output(LED_GREEN_PIN, GPIO.HIGH) # Green LED on
-        GPIO.output(LED_RED_PIN, GPIO.LOW)    # Red LED off
-        logging.info("Light is GREEN")
-    else:
-        # code to turn green LED ON and red LED OFF
-        GPIO.output(LED_GREEN_PIN, GPIO.LOW) # Green LED off
-        GPIO.output(LED_RED_PIN, GPIO.HIGH)  # Red LED on
-        logging.info("Light is RED")
+class GpioDevices:
+    """ Servo and red/green LEDs on Raspberry Pi GPIO pins """
+    def __init__(self):
+        """ Initialize servo pwm. Customize pin and Freq per variables """
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setwarnings(False)
+        GPIO.setup(SERVO_PIN, GPIO.OUT)
+        self.pwm = GPIO.PWM(SERVO_PIN, SERVO_FREQ)
+        GPIO.setup(LED_RED_PIN, GPIO.OUT)
+        GPIO.setup(LED_GREEN_PIN, GPIO.OUT)
+        self.pwm.start(SERVO_90)    # Set servo in Neutral 90 Position
+
+    def servo(self, duty_cycle):
+        """ Move servo to position for duty_cycle """
+        self.pwm.ChangeDutyCycle(duty_cycle)
+
+    def leds(self, green_on):
+        """ Set green and red leds """
+        if green_on:
+            GPIO.output(LED_GREEN_PIN, GPIO.HIGH) # Green LED on
+            GPIO.output(LED_RED_PIN, GPIO.LOW)    # Red LED off
+        else:
+            GPIO.output(LED_GREEN_PIN, GPIO.LOW) # Green LED off
+            GPIO.output(LED_RED_PIN, GPIO.HIGH)  # Red LED on
+
+    def cleanup(self):
+        """ Release GPIO pins """
+        self.pwm.stop()
+        GPIO.cleanup()
 
 #------------------------------------------------------------------------------
-def control_servo(is_open):
+class SimulatedDevices:
     """
-    Sample Code to toggle servo open or closed based on boolean
-    is_open variable
+    Stand in for GpioDevices that records servo and LED changes
+    with a timestamp so timing can be checked without a Raspberry Pi
     """
-    if is_open:
-        p.ChangeDutyCycle(SERVO_180) # Move Servo to 180 Degrees
-        time.sleep(1)
-        led_green(False) # green led off and red on
-        logging.info("Servo is Closed")
-        is_open = False  # Set position for next toggle
-    else:
-        p.ChangeDutyCycle(SERVO_90) # Move Servo to 90 Degrees
-        time.sleep(1)
-        led_green(True)  # green led on and red off
-        logging.info("Servo is Open")
-        is_open = True  # set position for next toggle
-    return is_open
+    def __init__(self):
+        self.history = []  # list of (time, device, value)
+
+    def servo(self, duty_cycle):
+        """ Record servo position """
+        self.history.append((time.time(), "servo", duty_cycle))
+        logging.info("Simulated servo duty cycle %.1f", duty_cycle)
+
+    def leds(self, green_on):
+        """ Record led state """
+        self.history.append((time.time(), "green", green_on))
+        logging.info("Simulated green led %s", green_on)
+
+    def cleanup(self):
+        """ Nothing to release """
+        return
 
 #------------------------------------------------------------------------------
-def timer_on(change_time, duration):
-    right_now = datetime.datetime.now()
-    time_diff = (right_now - change_time).total_seconds()
-    if time_diff > duration:
-        start = True
-    else:
-        start = False
-    return start
+class DeviceController:
+    """
+    Toggle the servo gate and stop light from a worker thread.
+    Tracking only queues crossing events so servo moves and the
+    LIGHT_TIMER logic never pause motion tracking.
+    """
+    def __init__(self, devices):
+        self.devices = devices
+        self.commands = queue.Queue()
+        self.pending = []          # heap of (due time, green_on) led changes
+        self.light_timer = LIGHT_TIMER
+        self.change_time = time.time()
+        self.servo_open = True
+        self.crossings = 0         # crossings since last servo change
+        self.thread = None
+
+    def start(self):
+        """ start the thread to run device commands """
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def update(self):
+        """ run queued commands and timed led changes until stopped """
+        self.devices.leds(True)
+        logging.info("Servo is Open at 90 Light is GREEN light_timer=%i sec",
+                     self.light_timer)
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(0.0, self.pending[0][0] - time.time())
+            try:
+                command = self.commands.get(timeout=timeout)
+            except queue.Empty:
+                command = None
+            if command == "stop":
+                break
+            elif command == "crossing":
+                self.crossed()
+            while self.pending and self.pending[0][0] <= time.time():
+                green_on = heapq.heappop(self.pending)[1]
+                self.devices.leds(green_on)
+                logging.info("Light is %s", "GREEN" if green_on else "RED")
+        self.devices.cleanup()
+
+    def crossed(self):
+        """ Toggle servo if light_timer has expired since last change """
+        self.crossings += 1
+        if time.time() - self.change_time <= self.light_timer:
+            return
+        if self.crossings > 3:
+            self.light_timer = self.light_timer - 1
+            if self.light_timer < 10:
+                logging.info("light_timer is at min value")
+                self.light_timer = 10
+            logging.info("Changed light_timer to %i sec", self.light_timer)
+        if self.servo_open:
+            self.devices.servo(SERVO_180) # Move Servo to 180 Degrees
+            logging.info("Servo is Closed")
+        else:
+            self.devices.servo(SERVO_90)  # Move Servo to 90 Degrees
+            logging.info("Servo is Open")
+        self.servo_open = not self.servo_open
+        # Change lights once the servo has had time to move
+        heapq.heappush(self.pending, (time.time() + SERVO_MOVE_TIME,
+                                      self.servo_open))
+        self.change_time = time.time()
+        self.crossings = 0
+
+    def crossing(self):
+        """ queue a crossing event. Never blocks """
+        self.commands.put("crossing")
+
+    def stop(self):
+        """ stop the thread and release devices """
+        self.commands.put("stop")
+        if self.thread is not None:
+            self.thread.join(2.0)
+
+#------------------------------------------------------------------------------
+class JpegOutput:
+    """
+    File like picamera recording output that keeps the most recent
+    complete MJPEG frame so event images are saved without re-encoding
+    """
+    def __init__(self):
+        self.jpeg = None
+        self.parts = []
+
+    def write(self, buf):
+        """ collect frame parts until the jpeg end of image marker """
+        self.parts.append(buf)
+        if buf.endswith(b"\xff\xd9"):
+            self.jpeg = b"".join(self.parts)
+            self.parts = []
+        return len(buf)
+
+    def flush(self):
+        """ nothing buffered to flush """
+        return
+
+#------------------------------------------------------------------------------
+class YPlaneOutput:
+    """
+    File like picamera yuv recording output.  Passes the Y (luma) plane
+    of each frame to callback as a zero copy numpy view
+    """
+    def __init__(self, resolution, callback):
+        self.width, self.height = resolution
+        # picamera pads yuv frames to a multiple of 32 wide and 16 high
+        self.padded_width = (self.width + 31) // 32 * 32
+        self.padded_height = (self.height + 15) // 16 * 16
+        self.callback = callback
+
+    def write(self, buf):
+        """ each write is one complete yuv420 frame """
+        y_plane = np.frombuffer(buf, dtype=np.uint8,
+                                count=self.padded_width * self.padded_height)
+        y_plane = y_plane.reshape(self.padded_height, self.padded_width)
+        self.callback(y_plane[:self.height, :self.width])
+        return len(buf)
+
+    def flush(self):
+        """ nothing buffered to flush """
+        return
 
 #------------------------------------------------------------------------------
 class PiVideoStream:
@@ -221,50 +356,156 @@ class PiVideoStream:
                  hflip=False, vflip=False):
         """ initialize the camera and stream """
         self.camera = PiCamera()
-        self.camera.resolution = resolution
-        self.camera.rotation = rotation
-        self.camera.framerate = framerate
-        self.camera.hflip = hflip
-        self.camera.vflip = vflip
-        self.rawCapture = PiRGBArray(self.camera, size=resolution)
-        self.stream = self.camera.capture_continuous(self.rawCapture,
-                                                     format="bgr",
-                                                     use_video_port=True)
-        # initialize the frame and the variable used to indicate
-        # if the thread should be stopped
+        self.stream = None
+        self.rawCapture = None
+        self.jpeg_output = None
+        self.recording = []       # splitter ports to stop on close
+        self.close_lock = Lock()
+        self.closed = False
+        self.thread = None
+        # initialize the frame and the variable used to indicate if the
+        # thread should be stopped.  Set before recording starts since
+        # YPlaneOutput calls new_frame() as soon as it does
         self.frame = None
+        self.frame_time = time.time()  # time of last good frame for watchdog
+        self.timed_frame = (None, self.frame_time)  # frame and time as one pair
+        self.ready = Event()           # set after STREAM_READY_FRAMES good frames
+        self.good_frames = 0           # count of consecutive good frames
         self.stopped = False
+        try:
+            self.camera.resolution = resolution
+            self.camera.rotation = rotation
+            self.camera.framerate = framerate
+            self.camera.hflip = hflip
+            self.camera.vflip = vflip
+            if GRAY_CAPTURE_ON:
+                # Record yuv and use only the Y plane. No bgr conversion
+                self.y_output = YPlaneOutput(resolution, self.new_frame)
+                self.camera.start_recording(self.y_output, format="yuv",
+                                            splitter_port=1)
+                self.recording.append(1)
+            else:
+                self.rawCapture = PiRGBArray(self.camera, size=resolution)
+                self.stream = self.camera.capture_continuous(self.rawCapture,
+                                                             format="bgr",
+                                                             use_video_port=True)
+            # Record MJPEG on a second splitter port for saved images
+            if SAVE_IMAGES and JPEG_CAPTURE_ON:
+                self.jpeg_output = JpegOutput()
+                self.camera.start_recording(self.jpeg_output, format="mjpeg",
+                                            splitter_port=2, quality=JPEG_QUALITY)
+                self.recording.append(2)
+        except Exception:
+            # Do not leave the camera open or every retry finds it in use
+            self.close()
+            raise
 
     def start(self):
         """ start the thread to read frames from the video stream """
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
         return self
 
     def update(self):
         """ keep looping infinitely until the thread is stopped """
-        for f in self.stream:
-            # grab the frame from the stream and clear the stream in
-            # preparation for the next frame
-            self.frame = f.array
-            self.rawCapture.truncate(0)
+        try:
+            if self.stream is None:
+                # Gray frames arrive through YPlaneOutput callbacks
+                while not self.stopped:
+                    self.camera.wait_recording(0.5, splitter_port=1)
+            else:
+                for f in self.stream:
+                    # grab the frame from the stream and clear the stream in
+                    # preparation for the next frame
+                    self.new_frame(f.array)
+                    self.rawCapture.truncate(0)
 
-            # if the thread indicator variable is set, stop the thread
-            # and resource camera resources
-            if self.stopped:
-                self.stream.close()
-                self.rawCapture.close()
-                self.camera.close()
+                    # if the thread indicator variable is set, stop the thread
+                    # and resource camera resources
+                    if self.stopped:
+                        break
+        except Exception as err:
+            # Leave it to the watchdog in track() to restart the camera
+            if not self.stopped:
+                logging.error("PiCamera stream failed: %s", err)
+        self.close()
+
+    def close(self):
+        """
+        Stop recording and close the camera.  Called by the stream thread
+        when it ends and by stop(), so only the first call does anything
+        """
+        with self.close_lock:
+            if self.closed:
                 return
+            self.closed = True
+        for port in self.recording:
+            try:
+                self.camera.stop_recording(splitter_port=port)
+            except Exception as err:
+                logging.warning("PiCamera port %i did not stop: %s", port, err)
+        resources = [self.rawCapture, self.camera]
+        if current_thread() is self.thread:
+            # Only the stream thread can close the capture generator.
+            # Closing the camera ends it if it is blocked in another thread
+            resources.insert(0, self.stream)
+        for resource in resources:
+            if resource is None:
+                continue
+            try:
+                resource.close()
+            except Exception as err:
+                logging.warning("PiCamera close failed: %s", err)
+
+    def new_frame(self, frame):
+        """ save latest frame and its time for read() and the watchdog """
+        self.frame = frame
+        self.frame_time = time.time()
+        self.timed_frame = (frame, self.frame_time)
+        self.good_frames += 1
+        if self.good_frames >= STREAM_READY_FRAMES:
+            self.ready.set()
 
     def read(self):
         """ return the frame most recently read """
         return self.frame
 
+    def read_timed(self):
+        """ return the most recent (frame, frame_time) pair """
+        return self.timed_frame
+
+    def read_jpeg(self):
+        """ return the most recent camera jpeg bytes or None """
+        if self.jpeg_output is None:
+            return None
+        return self.jpeg_output.jpeg
+
+    def wait_ready(self, timeout):
+        """ wait for consecutive good frames. Return True if stream is ready """
+        return self.ready.wait(timeout)
+
+    def stalled(self, timeout):
+        """ return True if no new frame has arrived for timeout seconds """
+        return time.time() - self.frame_time > timeout
+
     def stop(self):
-        """ indicate that the thread should be stopped """
+        """
+        Stop the thread and close the camera.  A stalled stream thread
+        never gets back to check stopped, so the camera is closed from
+        here, which also ends the blocked capture
+        """
         self.stopped = True
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join(0.5)   # let a running stream end itself
+        self.close()
+
+    def join(self, timeout):
+        """ wait for the stream thread to end. Return True if it has """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
 
 #------------------------------------------------------------------------------
 class WebcamVideoStream:
@@ -279,16 +520,39 @@ class WebcamVideoStream:
         self.stream = cv2.VideoCapture(CAM_SRC)
         self.stream.set(3, CAM_WIDTH)
         self.stream.set(4, CAM_HEIGHT)
-        (self.grabbed, self.frame) = self.stream.read()
+        if SAVE_IMAGES and JPEG_CAPTURE_ON and isinstance(CAM_SRC, int):
+            # Ask a camera device for MJPEG and undecoded frames so the
+            # camera jpeg can be saved as is. Drivers that ignore this
+            # return decoded frames and read_jpeg() returns None
+            self.stream.set(cv2.CAP_PROP_FOURCC,
+                            cv2.VideoWriter_fourcc(*"MJPG"))
+            self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        elif GRAY_CAPTURE_ON and isinstance(CAM_SRC, int):
+            # Ask a camera device for raw YUYV frames and use the Y channel
+            self.stream.set(cv2.CAP_PROP_FOURCC,
+                            cv2.VideoWriter_fourcc(*"YUYV"))
+            self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.frame_time = time.time()  # time of last good frame for watchdog
+        self.ready = Event()           # set after STREAM_READY_FRAMES good frames
+        self.good_frames = 0           # count of consecutive good frames
+        self.frame = None
+        self.jpeg = None
+        self.close_lock = Lock()
+        self.closed = False
+        self.thread = None
+        self.grabbed = self.grab_frame() or self.grab_frame()
+        self.timed_frame = (self.frame, self.frame_time)  # frame and time as one pair
+        if self.grabbed:
+            self.good_frames = 1
         # initialize the variable used to indicate if the thread should
         # be stopped
         self.stopped = False
 
     def start(self):
         """ start the thread to read frames from the video stream """
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
         return self
 
     def update(self):
@@ -296,17 +560,1060 @@ class WebcamVideoStream:
         while True:
             # if the thread indicator variable is set, stop the thread
             if self.stopped:
+                self.close()
                 return
             # otherwise, read the next frame from the stream
-            (self.grabbed, self.frame) = self.stream.read()
+            grabbed = self.grab_frame()
+            self.grabbed = grabbed
+            if grabbed:
+                self.frame_time = time.time()
+                self.timed_frame = (self.frame, self.frame_time)
+                self.good_frames += 1
+                if self.good_frames >= STREAM_READY_FRAMES:
+                    self.ready.set()
+            else:
+                self.good_frames = 0
+                # Keep last good frame and let the watchdog decide
+                # when to restart the camera.  Avoid a busy spin.
+                time.sleep(0.1)
 
     def read(self):
         """ return the frame most recently read """
         return self.frame
 
+    def read_timed(self):
+        """ return the most recent (frame, frame_time) pair """
+        return self.timed_frame
+
+    def grab_frame(self):
+        """ read next frame and keep its jpeg bytes if undecoded """
+        (grabbed, frame) = self.stream.read()
+        if not grabbed:
+            return False
+        if frame.ndim < 3:
+            jpeg = frame.tobytes()
+            if not jpeg.startswith(b"\xff\xd8"):
+                # Driver returned raw frames we can not use
+                # so go back to decoded frames
+                logging.warning("Camera raw frame capture not supported")
+                self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                return False
+            # Undecoded MJPEG buffer from the driver. A grayscale
+            # decode skips the jpeg color planes
+            if GRAY_CAPTURE_ON:
+                frame = cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)
+            else:
+                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+            if frame is None:
+                return False
+            self.jpeg = jpeg
+        elif frame.shape[2] == 2:
+            frame = frame[:, :, 0]   # Y channel of a raw YUYV frame
+        elif GRAY_CAPTURE_ON:
+            # Driver only delivers bgr so convert here off the tracking thread
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.frame = frame
+        return True
+
+    def read_jpeg(self):
+        """ return the most recent camera jpeg bytes or None """
+        return self.jpeg
+
+    def wait_ready(self, timeout):
+        """ wait for consecutive good frames. Return True if stream is ready """
+        return self.ready.wait(timeout)
+
+    def stalled(self, timeout):
+        """ return True if no new frame has arrived for timeout seconds """
+        return time.time() - self.frame_time > timeout
+
+    def close(self):
+        """ release the camera. Only the first call does anything """
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.stream.release()
+
     def stop(self):
-        """ indicate that the thread should be stopped """
+        """
+        Stop the thread and release the camera.  A read() blocked on a
+        stalled camera never gets back to check stopped, so the camera
+        is released from here
+        """
         self.stopped = True
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join(0.5)   # let a running stream end itself
+        self.close()
+
+    def join(self, timeout):
+        """ wait for the stream thread to end. Return True if it has """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+#------------------------------------------------------------------------------
+RECORD_MAGIC = b"INOUTREC"
+RECORD_HEADER = "<8sIIIII"  # magic, version, frames, height, width, channels
+RECORD_HEADER_SIZE = 32     # header is padded so frame times are aligned
+
+class SessionRecorder:
+    """
+    Record the frames track() processes with their frame times so a
+    session can be replayed exactly with replay.py.  The tracking thread
+    only collects frame references.  A background thread writes each
+    chunk of RECORD_CHUNK_FRAMES with one large sequential write and
+    deletes the oldest chunk files when RECORD_PATH is over RECORD_MAX_MB.
+
+    Chunk file layout is a 32 byte header, frame times as float64 then
+    uint8 frames, so read_recording() can memory map any chunk.
+    """
+    def __init__(self, path=RECORD_PATH, chunk_frames=RECORD_CHUNK_FRAMES,
+                 max_mb=RECORD_MAX_MB, scale=RECORD_SCALE):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.max_bytes = max_mb * 1024 * 1024
+        self.scale = scale
+        self.frames = []
+        self.times = []
+        self.last_time = None
+        self.chunks = queue.Queue(2)
+        self.thread = None
+        if not os.path.isdir(path):
+            logging.info("Creating Recording Folder %s", path)
+            os.makedirs(path)
+
+    def start(self):
+        """ start the thread to write chunk files """
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def add(self, frame, frame_time):
+        """ collect a processed frame. Never blocks the tracking loop """
+        if frame_time == self.last_time:
+            # track() saw this camera frame already. Repeats have no
+            # difference image so skipping them keeps replays exact
+            return
+        self.last_time = frame_time
+        self.frames.append(frame)
+        self.times.append(frame_time)
+        if len(self.frames) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        """ hand collected frames to the writer thread """
+        if not self.frames:
+            return
+        try:
+            self.chunks.put_nowait((self.frames, self.times))
+        except queue.Full:
+            logging.warning("Recorder behind. Dropped %i frames",
+                            len(self.frames))
+        self.frames = []
+        self.times = []
+
+    def update(self):
+        """ write chunks until stopped """
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            try:
+                self.write_chunk(*chunk)
+                self.rotate()
+            except (IOError, OSError, ValueError) as err:
+                logging.error("Recording failed: %s", err)
+
+    def write_chunk(self, frames, times):
+        """ write one chunk file. Renamed when complete """
+        if self.scale != 1.0:
+            frames = [cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                                 interpolation=cv2.INTER_AREA)
+                      for frame in frames]
+        data = np.stack(frames)
+        if data.ndim == 3:
+            data = data[..., np.newaxis]
+        count, height, width, channels = data.shape
+        right_now = datetime.datetime.now()
+        filename = os.path.join(self.path, "rec-%s.rec"
+                                % right_now.strftime("%Y%m%d-%H%M%S-%f"))
+        header = struct.pack(RECORD_HEADER, RECORD_MAGIC, 1, count,
+                             height, width, channels)
+        f = open(filename + ".part", "wb")
+        f.write(header.ljust(RECORD_HEADER_SIZE, b"\0"))
+        f.write(np.asarray(times, dtype=np.float64).tobytes())
+        f.write(data.tobytes())
+        f.close()
+        os.rename(filename + ".part", filename)
+
+    def rotate(self):
+        """ delete oldest chunk files while folder is over max size """
+        files = sorted([os.path.join(self.path, name)
+                        for name in os.listdir(self.path)
+                        if name.endswith(".rec")])
+        total = sum([os.path.getsize(name) for name in files])
+        while files and total > self.max_bytes:
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            logging.info("Removed old recording %s", oldest)
+
+    def stop(self):
+        """ write remaining frames and stop the writer thread """
+        self.flush()
+        self.chunks.put(None)
+        if self.thread is not None:
+            self.thread.join(10.0)
+
+#------------------------------------------------------------------------------
+def read_recording(filename):
+    """
+    Memory map a recording chunk file.
+    Returns (frame times, frames) numpy arrays
+    """
+    f = open(filename, "rb")
+    header = f.read(struct.calcsize(RECORD_HEADER))
+    f.close()
+    magic, version, count, height, width, channels = struct.unpack(
+        RECORD_HEADER, header)
+    if magic != RECORD_MAGIC:
+        raise ValueError("%s is not a recording file" % filename)
+    times = np.memmap(filename, dtype=np.float64, mode="r",
+                      offset=RECORD_HEADER_SIZE, shape=(count,))
+    frames = np.memmap(filename, dtype=np.uint8, mode="r",
+                       offset=RECORD_HEADER_SIZE + 8 * count,
+                       shape=(count, height, width, channels))
+    if channels == 1:
+        frames = frames[..., 0]
+    return times, frames
+
+#------------------------------------------------------------------------------
+class RecordedVideoStream:
+    """
+    Replay recording chunk files in place of a camera stream.  Each
+    read() returns the next recorded frame with its recorded frame_time.
+    """
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.times, self.frames = read_recording(self.filenames.pop(0))
+        self.index = 0
+        self.frame = None
+        self.frame_time = 0.0
+        self.frame_number = 0
+
+    def start(self):
+        """ nothing to start. Frames are read from the files """
+        return self
+
+    def read(self):
+        """ return the next recorded frame """
+        if self.index >= len(self.frames) and self.filenames:
+            self.times, self.frames = read_recording(self.filenames.pop(0))
+            self.index = 0
+        if self.index < len(self.frames):
+            self.frame = np.array(self.frames[self.index])
+            self.frame_time = float(self.times[self.index])
+            self.index += 1
+            self.frame_number += 1
+        return self.frame
+
+    def read_timed(self):
+        """ return the next recorded (frame, frame_time) pair """
+        frame = self.read()
+        return frame, self.frame_time
+
+    def read_jpeg(self):
+        """ recordings have no camera jpeg """
+        return None
+
+    def wait_ready(self, timeout):
+        """ recordings are always ready """
+        return True
+
+    def stalled(self, timeout):
+        """ report a stall after the last frame so track() returns """
+        return self.index >= len(self.frames) and not self.filenames
+
+    def stop(self):
+        """ nothing to stop """
+        return
+
+    def join(self, timeout):
+        """ no thread to wait for """
+        return True
+
+#------------------------------------------------------------------------------
+def stop_stream(stream):
+    """
+    Stop a camera stream and wait for its thread so the camera device
+    is free before it is opened again
+    """
+    stream.stop()
+    if not stream.join(STREAM_STOP_TIMEOUT):
+        logging.warning("Camera thread still running after %.1f sec",
+                        STREAM_STOP_TIMEOUT)
+
+#------------------------------------------------------------------------------
+def start_stream(old_stream=None):
+    """
+    Start the camera stream and wait for consecutive good frames.
+    Retry with exponential backoff until the stream is ready.
+    A stalled old_stream is stopped first so its camera is released.
+    """
+    if old_stream is not None:
+        stop_stream(old_stream)
+    retry_delay = STREAM_RETRY_MIN
+    start_time = time.time()
+    while True:
+        if WEBCAM:   #  Start Web Cam stream (Note USB webcam must be plugged in)
+            print("Initializing USB Web Camera ....")
+            stream = WebcamVideoStream().start()
+        else:
+            print("Initializing Pi Camera ....")
+            try:
+                stream = PiVideoStream(rotation=CAMERA_ROTATION,
+                                       hflip=CAMERA_HFLIP,
+                                       vflip=CAMERA_VFLIP).start()
+            except Exception as err:
+                logging.error("PiCamera failed to start: %s", err)
+                stream = None
+        if stream is not None and stream.wait_ready(STREAM_READY_TIMEOUT):
+            logging.info("Camera stream ready in %.2f sec",
+                         time.time() - start_time)
+            bus.publish("health", status="ready",
+                        seconds=time.time() - start_time)
+            return stream
+        if stream is not None:
+            stop_stream(stream)
+        logging.warning("Camera stream not ready. Retry in %.1f sec",
+                        retry_delay)
+        bus.publish("health", status="retry", seconds=retry_delay)
+        time.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, STREAM_RETRY_MAX)
+
+#------------------------------------------------------------------------------
+class EventBus:
+    """
+    Publish crossing, track and health events to local subscribers.
+    Each subscriber gets its own bounded queue.  A subscriber whose
+    queue is full is dropped so a stalled client never slows tracking.
+    Subscribers that must see every event of a few types, like the
+    event spool, ask for only those types and an unbounded queue.
+    """
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = []  # replaced not changed so publish needs no lock
+        self.lock = Lock()
+
+    def subscribe(self, event_types=None, queue_size=None):
+        """
+        return a new queue that receives published events.  event_types
+        limits it to those types.  queue_size 0 never fills or drops
+        """
+        if queue_size is None:
+            queue_size = self.queue_size
+        events = queue.Queue(queue_size)
+        events.dropped = False
+        events.event_types = event_types
+        with self.lock:
+            self.subscribers = self.subscribers + [events]
+        return events
+
+    def unsubscribe(self, events):
+        """ stop sending events to a subscriber queue """
+        events.dropped = True
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not events]
+
+    def publish(self, event_type, **data):
+        """ send an event dict to every subscriber. Never blocks """
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        data["type"] = event_type
+        data["time"] = time.time()
+        for events in subscribers:
+            if events.event_types and event_type not in events.event_types:
+                continue
+            try:
+                events.put_nowait(data)
+            except queue.Full:
+                logging.warning("Dropping slow event subscriber")
+                self.unsubscribe(events)
+
+#------------------------------------------------------------------------------
+class EventSocketServer:
+    """ Send bus events as JSON lines to clients of a local Unix socket """
+    def __init__(self, event_bus, path=EVENT_SOCKET_PATH):
+        self.bus = event_bus
+        if os.path.exists(path):
+            os.remove(path)   # left over from a previous run
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        logging.info("Publishing events on %s", path)
+
+    def start(self):
+        """ start the thread to accept subscriber connections """
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        """ give each connected client its own sender thread """
+        while True:
+            client, _ = self.server.accept()
+            t = Thread(target=self.send_events, args=(client,))
+            t.daemon = True
+            t.start()
+
+    def send_events(self, client):
+        """ send events to one client until it disconnects or is dropped """
+        events = self.bus.subscribe()
+        client.settimeout(5.0)
+        try:
+            while not events.dropped:
+                try:
+                    event = events.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                client.sendall((json.dumps(event) + "\n").encode("utf-8"))
+        except socket.error:
+            pass
+        self.bus.unsubscribe(events)
+        client.close()
+
+#------------------------------------------------------------------------------
+class EventSpool:
+    """
+    Forward crossing events to an aggregator.py node.  Each event gets an
+    id of tracker, run and sequence number and is appended to a spool file
+    in SPOOL_PATH, so a network outage never blocks tracking or loses events.
+    The tracker id is random and saved in SPOOL_PATH, since trackers left
+    on the default Raspbian host name would otherwise share one id.
+    A sender thread posts each closed spool file as one gzip batch, oldest
+    first, and only deletes it once the aggregator has accepted it.
+    """
+    def __init__(self, event_bus, url=SPOOL_URL, path=SPOOL_PATH,
+                 site=SITE_NAME, batch_events=SPOOL_BATCH_EVENTS,
+                 batch_sec=SPOOL_BATCH_SEC, retry_max=SPOOL_RETRY_MAX):
+        self.bus = event_bus
+        self.url = url
+        self.path = path
+        self.site = site or socket.gethostname()
+        self.batch_events = batch_events
+        self.batch_sec = batch_sec
+        self.retry_max = retry_max
+        self.seq = 0
+        self.spool = None             # open spool .part file
+        self.spool_name = None
+        self.spool_events = 0
+        self.spool_bytes = 0          # bytes of whole events in the spool file
+        self.spool_time = 0.0
+        # Crossings only and an unbounded queue, so bursts of track events
+        # never get the spool dropped as a slow subscriber
+        self.events = event_bus.subscribe(("crossing",), 0)
+        self.stopped = False
+        self.writer = None
+        if not os.path.isdir(path):
+            logging.info("Creating Event Spool Folder %s", path)
+            os.makedirs(path)
+        # Close spool files left open by a previous run so they are sent
+        for name in os.listdir(path):
+            if name.endswith(".part"):
+                part = os.path.join(path, name)
+                os.rename(part, part[:-len(".part")])
+        # run number orders events over restarts
+        self.tracker, self.run = self.next_run()
+        # Random per run so the aggregator can tell a run number reused
+        # from an old copy of SPOOL_PATH/tracker from a resent batch
+        self.run_key = uuid.uuid4().hex[:8]
+
+    def next_run(self):
+        """
+        Return (tracker id, run number) from SPOOL_PATH/tracker and save
+        the run number plus one.  The run is a counter, not the clock, since
+        a Pi without a real time clock can start with a time before its
+        last run.  Both are kept in one file so a lost counter also means
+        a new tracker id, and the aggregator never takes the new run's
+        events for ones it already counted
+        """
+        tracker_path = os.path.join(self.path, "tracker")
+        if os.path.exists(tracker_path):
+            with open(tracker_path) as f:
+                tracker, run = f.read().split()
+            run = int(run)
+        else:
+            tracker, run = uuid.uuid4().hex[:12], 0
+            logging.info("New aggregator tracker id %s", tracker)
+        run += 1
+        # Saved before any event is written so a crash never reuses a run
+        with open(tracker_path + ".tmp", "w") as f:
+            f.write("%s %i\n" % (tracker, run))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tracker_path + ".tmp", tracker_path)
+        return tracker, run
+
+    def start(self):
+        """ start the spool writer and sender threads """
+        self.writer = Thread(target=self.update, args=())
+        for t in (self.writer, Thread(target=self.send, args=())):
+            t.daemon = True
+            t.start()
+        return self
+
+    def update(self):
+        """
+        Append crossing events to the open spool file.  While the disk
+        can not be written events wait in the queue and are retried
+        """
+        event = None
+        while not self.stopped:
+            if event is None:
+                try:
+                    event = self.events.get(timeout=1.0)
+                except queue.Empty:
+                    pass
+            try:
+                if event is not None:
+                    self.write(event)
+                    event = None
+                if self.spool is not None and (
+                        self.spool_events >= self.batch_events or
+                        time.time() - self.spool_time >= self.batch_sec):
+                    self.close()
+            except (IOError, OSError) as err:
+                logging.error("Event spool write failed: %s. Retry in 5.0 sec",
+                              err)
+                time.sleep(5.0)
+        # Write events still queued when stopped
+        try:
+            while True:
+                if event is None:
+                    event = self.events.get_nowait()
+                self.write(event)
+                event = None
+        except queue.Empty:
+            pass
+        except (IOError, OSError) as err:
+            logging.error("Event spool lost %i events at exit: %s",
+                          self.events.qsize() + 1, err)
+        try:
+            self.close()
+        except (IOError, OSError) as err:
+            logging.error("Event spool close failed: %s", err)
+
+    def write(self, event):
+        """ give event an id and add it to the open spool file """
+        seq = self.seq + 1
+        event = dict(event, site=self.site, tracker=self.tracker,
+                     run=self.run, run_key=self.run_key, seq=seq,
+                     id="%s:%i:%i" % (self.tracker, self.run, seq))
+        line = json.dumps(event) + "\n"
+        if self.spool is None:
+            # names sort in event order for the sender
+            self.spool_name = os.path.join(
+                self.path, "spool-%010i-%010i.jsonl" % (self.run, seq))
+            self.spool = open(self.spool_name + ".part", "a")
+            self.spool_events = 0
+            self.spool_bytes = 0
+            self.spool_time = time.time()
+        try:
+            self.spool.write(line)
+            self.spool.flush()
+        except (IOError, OSError):
+            self.abandon()
+            raise
+        self.seq = seq
+        self.spool_events += 1
+        self.spool_bytes += len(line)
+
+    def abandon(self):
+        """
+        Close a spool file that could not be written.  It is cut back to
+        its last whole event so the aggregator can still read it
+        """
+        spool, self.spool = self.spool, None
+        part = self.spool_name + ".part"
+        try:
+            spool.close()
+        except (IOError, OSError):
+            pass
+        try:
+            os.truncate(part, self.spool_bytes)
+            if self.spool_events:
+                os.rename(part, self.spool_name)
+            else:
+                os.remove(part)
+        except (IOError, OSError) as err:
+            # Renamed and sent on the next run once the disk is writable
+            logging.error("Could not close spool file %s: %s", part, err)
+
+    def close(self):
+        """ close the open spool file so the sender can post it """
+        if self.spool is None:
+            return
+        spool, self.spool = self.spool, None
+        spool.close()
+        os.rename(self.spool_name + ".part", self.spool_name)
+
+    def send(self):
+        """ post spool files oldest first. Back off while unreachable """
+        # Only loaded when the spool is on so startup stays fast
+        from http.client import HTTPException
+        from urllib.error import HTTPError
+        retry_delay = 1.0
+        while not self.stopped:
+            try:
+                sent = self.send_oldest()
+            except HTTPError as err:
+                if err.code == 409:
+                    # SPOOL_PATH/run was reset.  Events wait here until
+                    # the aggregator state for this tracker is fixed
+                    logging.error("Aggregator has counted run %i or later for "
+                                  "tracker %s. Retry in %.1f sec",
+                                  self.run, self.tracker, retry_delay)
+                else:
+                    logging.warning("Aggregator error %s. Retry in %.1f sec",
+                                    err.code, retry_delay)
+            except (HTTPException, IOError, OSError) as err:
+                # Unreachable, a bad reply or the spool folder could not
+                # be read.  All are retried the same way
+                logging.warning("Aggregator send failed %s. Retry in %.1f sec",
+                                err, retry_delay)
+            else:
+                if sent is None:
+                    time.sleep(1.0)   # nothing to send
+                else:
+                    retry_delay = 1.0
+                continue
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, self.retry_max)
+
+    def send_oldest(self):
+        """
+        Post the oldest closed spool file and delete it once accepted.
+        Returns None if there is nothing to send, else the file name
+        """
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        names = sorted([name for name in os.listdir(self.path)
+                        if name.endswith(".jsonl")])
+        if not names:
+            return None
+        filename = os.path.join(self.path, names[0])
+        with open(filename, "rb") as f:
+            data = f.read()
+        body = io.BytesIO()
+        with gzip.GzipFile(fileobj=body, mode="wb") as z:
+            z.write(data)
+        request = Request(self.url, body.getvalue(),
+                          {"Content-Type": "application/x-ndjson",
+                           "Content-Encoding": "gzip"})
+        try:
+            urlopen(request, timeout=10.0).read()
+        except HTTPError as err:
+            if err.code != 400:
+                raise
+            # Resending a batch the aggregator can not read would
+            # hold back every later event
+            logging.error("Aggregator rejected %s. Kept as .rejected",
+                          filename)
+            os.rename(filename, filename + ".rejected")
+            return filename
+        os.remove(filename)
+        return filename
+
+    def stop(self):
+        """
+        Stop threads once queued events are written.  Unsent spool
+        files are sent on the next run
+        """
+        self.bus.unsubscribe(self.events)
+        self.stopped = True
+        if self.writer is not None:
+            self.writer.join(10.0)
+
+#------------------------------------------------------------------------------
+class Occupancy:
+    """
+    Running occupancy estimate updated once per enter or leave event.
+    The raw count is clamped at zero and reset at OCCUPANCY_RESET_TIMES.
+    At each reset the count left over is the drift from missed events.
+    The reset only shows the net drift for the whole day, so it is
+    learned as one correction per event and subtracted from later
+    events to give a drift corrected estimate.  Other threads call read()
+    which returns a snapshot tuple without locking the tracking loop.
+    """
+    def __init__(self, reset_times=OCCUPANCY_RESET_TIMES,
+                 learn_rate=OCCUPANCY_LEARN_RATE,
+                 drift_path=BASE_DIR + PROG_FILENAME + "-drift.json"):
+        self.reset_times = reset_times
+        self.learn_rate = learn_rate
+        self.drift_path = drift_path
+        self.drift = 0.0              # learned correction per event
+        if os.path.exists(drift_path):
+            try:
+                with open(drift_path) as f:
+                    self.drift = float(json.load(f)["drift"])
+            except (ValueError, KeyError, TypeError) as err:
+                logging.warning("Ignoring bad drift file %s: %s", drift_path, err)
+        self.day_enter = 0            # events since last reset
+        self.day_leave = 0
+        self.count = 0
+        self.estimate = 0.0
+        self.next_reset = self.get_next_reset()
+        self.snapshot = (0, 0.0, time.time())
+
+    def get_next_reset(self):
+        """ return epoch time of next scheduled reset or None """
+        right_now = datetime.datetime.now()
+        resets = []
+        for reset_time in self.reset_times:
+            hour, minute = [int(value) for value in reset_time.split(":")]
+            reset = right_now.replace(hour=hour, minute=minute,
+                                      second=0, microsecond=0)
+            if reset <= right_now:
+                reset += datetime.timedelta(days=1)
+            resets.append(reset)
+        if not resets:
+            return None
+        return time.mktime(min(resets).timetuple())
+
+    def check_reset(self):
+        """ Reset occupancy if a scheduled reset time has passed """
+        if self.next_reset is not None and time.time() >= self.next_reset:
+            self.reset()
+
+    def reset(self):
+        """ learn drift from counts left over since last reset and zero counts """
+        events = self.day_enter + self.day_leave
+        if events and self.learn_rate:
+            # Occupancy should be zero at reset so the net count is missed
+            # events. Which hours they were missed in is not known
+            rate = (self.day_enter - self.day_leave) / float(events)
+            self.drift += self.learn_rate * (rate - self.drift)
+            try:
+                with open(self.drift_path, "w") as f:
+                    json.dump({"drift": self.drift}, f)
+            except IOError as err:
+                logging.warning("Could not save drift file %s: %s",
+                                self.drift_path, err)
+        logging.info("Occupancy reset from %i (estimate %.1f)",
+                     self.count, self.estimate)
+        self.day_enter = 0
+        self.day_leave = 0
+        self.count = 0
+        self.estimate = 0.0
+        self.next_reset = self.get_next_reset()
+        self.snapshot = (0, 0.0, time.time())
+
+    def update(self, entered):
+        """ Add one enter or leave event. Returns drift corrected estimate """
+        self.check_reset()
+        if entered:
+            self.day_enter += 1
+            self.count += 1
+            self.estimate += 1.0 - self.drift
+        else:
+            self.day_leave += 1
+            self.count = max(0, self.count - 1)
+            self.estimate = max(0.0, self.estimate - 1.0 - self.drift)
+        self.snapshot = (self.count, self.estimate, time.time())
+        if OCCUPANCY_MAX and self.estimate > OCCUPANCY_MAX:
+            logging.warning("Occupancy %.1f is over limit %i",
+                            self.estimate, OCCUPANCY_MAX)
+        return self.estimate
+
+    def read(self):
+        """ return (count, estimate, update time) without locking """
+        return self.snapshot
+
+#------------------------------------------------------------------------------
+class DisplayStage:
+    """
+    Draw the center line, motion marker and counts for display outputs on
+    a thread of its own at up to DISPLAY_FPS, whatever the tracking fps.
+    track() only hands over references to its latest images and values.
+    Drawing is done on a copy so analysis frames are never changed, and
+    nothing is done at all while no output is attached.  Outputs are
+    callables given (overlay image, difference image, threshold image).
+    """
+    def __init__(self, fps=DISPLAY_FPS):
+        self.interval = 1.0 / fps
+        self.outputs = []      # replaced not changed so submit needs no lock
+        self.lock = Lock()
+        self.latest = None
+        self.next_time = 0.0
+        self.new_frame = Event()
+        self.quit = Event()    # set by an output to stop tracking
+        self.stopped = False
+
+    def attach(self, output):
+        """ start sending rendered frames to output """
+        with self.lock:
+            self.outputs = self.outputs + [output]
+
+    def detach(self, output):
+        """ stop sending rendered frames to output """
+        with self.lock:
+            self.outputs = [o for o in self.outputs if o is not output]
+
+    def start(self):
+        """ start the thread to render frames """
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def submit(self, image, difference_image, thresholdimage,
+               enter, leave, box):
+        """ offer the latest frame. Cheap when not due or nothing attached """
+        if not self.outputs:
+            return
+        now = time.time()
+        if now < self.next_time:
+            return
+        self.next_time = now + self.interval
+        self.latest = (image, difference_image, thresholdimage,
+                       enter, leave, box)
+        self.new_frame.set()
+
+    def update(self):
+        """ render each submitted frame and pass it to the outputs """
+        while not self.stopped:
+            if not self.new_frame.wait(1.0):
+                continue
+            self.new_frame.clear()
+            outputs = self.outputs
+            if not outputs:
+                continue
+            (image, difference_image, thresholdimage,
+             enter, leave, box) = self.latest
+            image = self.render(image, enter, leave, box)
+            for output in outputs:
+                output(image, difference_image, thresholdimage)
+
+    def render(self, image, enter, leave, box):
+        """ return a color copy of image with overlays drawn """
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        else:
+            image = image.copy()
+        if CENTER_LINE_VERT:
+            cv2.line(image, (X_CENTER, 0), (X_CENTER, Y_MAX), COLOR_TEXT, 2)
+        else:
+            cv2.line(image, (0, Y_CENTER), (X_MAX, Y_CENTER), COLOR_TEXT, 2)
+        if box is not None:
+            (x, y, w, h) = box
+            if SHOW_CIRCLE:
+                # show small circle at motion location
+                cv2.circle(image, (x + w // 2, y + h // 2), CIRCLE_SIZE,
+                           COLOR_MO, LINE_THICKNESS)
+            else:
+                cv2.rectangle(image, (x, y), (x + w, y + h),
+                              COLOR_MO, LINE_THICKNESS)
+        if INOUT_REVERSE:
+            img_text = ("LEAVE %i          ENTER %i" % (leave, enter))
+        else:
+            img_text = ("ENTER %i          LEAVE %i" % (enter, leave))
+        cv2.putText(image, img_text, (35, 15),
+                    TEXT_FONT, FONT_SCALE, (COLOR_TEXT), 1)
+        return image
+
+    def stop(self):
+        """ stop the render thread """
+        self.stopped = True
+
+#------------------------------------------------------------------------------
+class WindowOutput:
+    """
+    Show display frames in opencv windows.  The display stage thread only
+    hands over rendered frames.  track() calls show() from the main thread
+    since HighGUI windows must be used from it on macOS.  q in the window quits
+    """
+    def __init__(self, display, bigger=WINDOW_BIGGER):
+        self.display = display
+        self.bigger = bigger
+        self.latest = None
+
+    def __call__(self, image, difference_image, thresholdimage):
+        # Note setting a bigger window will slow the FPS
+        if self.bigger != 1:
+            image = cv2.resize(image, None, fx=self.bigger, fy=self.bigger)
+        self.latest = (image, difference_image, thresholdimage)
+
+    def show(self):
+        """ show the latest rendered frame if there is a new one """
+        frames = self.latest
+        if frames is None:
+            return
+        self.latest = None
+        image, difference_image, thresholdimage = frames
+        if DIFF_WINDOW_ON:
+            cv2.imshow('Difference Image', difference_image)
+        if THRESH_WINDOW_ON:
+            cv2.imshow('OpenCV Threshold', thresholdimage)
+        cv2.imshow('Press q in Window Quits)', image)
+        # Close Window if q pressed while mouse in opencv gui window
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            cv2.destroyAllWindows()
+            self.display.detach(self)
+            self.display.quit.set()
+
+#------------------------------------------------------------------------------
+class MjpegOutput:
+    """
+    Serve display frames as an MJPEG stream at http://<ip>:port/.
+    Only attached to the display stage while a viewer is connected
+    """
+    def __init__(self, display, port=DISPLAY_MJPEG_PORT, quality=JPEG_QUALITY):
+        self.display = display
+        self.quality = quality
+        self.jpeg = None
+        self.new_jpeg = Condition()
+        self.viewers = 0
+        self.lock = Lock()
+        output = self
+        # Only loaded when the MJPEG view is on so startup stays fast
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+            """ Handle each viewer on its own thread """
+            allow_reuse_address = True
+            daemon_threads = True
+
+        class Handler(BaseHTTPRequestHandler):
+            """ send the stream to each viewer """
+            def do_GET(self):
+                output.serve(self)
+
+            def log_message(self, format, *args):
+                return
+
+        self.server = ThreadedHTTPServer(("", port), Handler)
+        logging.info("MJPEG display stream on port %i", port)
+
+    def start(self):
+        """ start the thread to accept viewers """
+        t = Thread(target=self.server.serve_forever, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def __call__(self, image, difference_image, thresholdimage):
+        retval, jpeg = cv2.imencode(".jpg", image,
+                                    [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        with self.new_jpeg:
+            self.jpeg = jpeg.tobytes()
+            self.new_jpeg.notify_all()
+
+    def serve(self, handler):
+        """ send each new jpeg to one viewer until it disconnects """
+        handler.send_response(200)
+        handler.send_header("Content-Type",
+                            "multipart/x-mixed-replace; boundary=frame")
+        handler.end_headers()
+        with self.lock:
+            self.viewers += 1
+            if self.viewers == 1:
+                self.display.attach(self)
+        try:
+            while True:
+                with self.new_jpeg:
+                    self.new_jpeg.wait(5.0)
+                    jpeg = self.jpeg
+                if jpeg is None:
+                    continue
+                handler.wfile.write(("--frame\r\nContent-Type: image/jpeg\r\n"
+                                     "Content-Length: %i\r\n\r\n"
+                                     % len(jpeg)).encode("ascii"))
+                handler.wfile.write(jpeg + b"\r\n")
+        except (socket.error, IOError):
+            pass
+        finally:
+            with self.lock:
+                self.viewers -= 1
+                if not self.viewers:
+                    self.display.detach(self)
+                    self.jpeg = None
+
+#------------------------------------------------------------------------------
+class FlowConfirm:
+    """
+    Confirm candidate crossings with sparse Lucas-Kanade optical flow.
+    Corners are found only inside the blob bounding box of the current
+    frame and tracked back to the previous frame on a crop around the
+    box, so the cost is paid once per candidate crossing and not on every
+    frame.  A crossing is rejected when too few of the moving points go
+    its way, as when blobs merge or split across the center line.
+    """
+    def __init__(self, max_points=FLOW_MAX_POINTS, min_points=FLOW_MIN_POINTS,
+                 min_agree=FLOW_MIN_AGREE):
+        self.max_points = max_points
+        self.min_points = min_points
+        self.min_agree = min_agree
+        self.checks = 0      # candidate crossings checked
+        self.rejected = 0
+        self.seconds = 0.0   # total time spent checking
+
+    def agreement(self, grayimage1, grayimage2, box, entered):
+        """
+        Return the fraction of moving points going the crossing direction
+        or None when there are too few points to tell
+        """
+        (x, y, w, h) = box
+        # Points may move up to half the blob size between frames
+        margin = max(w, h) // 2
+        height, width = grayimage2.shape[:2]
+        x1, y1 = max(0, x - margin), max(0, y - margin)
+        x2, y2 = min(width, x + w + margin), min(height, y + h + margin)
+        crop1 = grayimage1[y1:y2, x1:x2]
+        crop2 = grayimage2[y1:y2, x1:x2]
+        mask = np.zeros(crop2.shape, dtype=np.uint8)
+        mask[y - y1:y - y1 + h, x - x1:x - x1 + w] = 255
+        points = cv2.goodFeaturesToTrack(crop2, self.max_points, 0.01, 3,
+                                         mask=mask)
+        if points is None or len(points) < self.min_points:
+            return None
+        back, status, err = cv2.calcOpticalFlowPyrLK(crop2, crop1, points, None,
+                                                     winSize=(15, 15), maxLevel=2)
+        # Motion from previous to current frame along the crossing axis
+        axis = 0 if CENTER_LINE_VERT else 1
+        motion = (points - back)[status.ravel() == 1, 0, axis]
+        moving = motion[np.abs(motion) >= 0.5]
+        if len(moving) < self.min_points:
+            return None
+        # Enter is movement toward lower x or y. See crossed_x_centerline()
+        if entered:
+            agree = np.count_nonzero(moving < 0)
+        else:
+            agree = np.count_nonzero(moving > 0)
+        return agree / float(len(moving))
+
+    def confirm(self, grayimage1, grayimage2, box, entered):
+        """ return False if flow in box disagrees with the crossing """
+        start = time.time()
+        agree = self.agreement(grayimage1, grayimage2, box, entered)
+        self.checks += 1
+        self.seconds += time.time() - start
+        if agree is not None and agree < self.min_agree:
+            self.rejected += 1
+            logging.info("Flow rejected %s. Only %.0f%% of points agree",
+                         "enter" if entered else "leave", 100.0 * agree)
+            return False
+        return True
+
+#------------------------------------------------------------------------------
+def gray_frame(image):
+    """ return grayscale image. Frames from GRAY_CAPTURE_ON are used as is """
+    return backend.gray(image)
 
 #------------------------------------------------------------------------------
 def show_loop_fps(start_time, frame_count):
@@ -333,6 +1640,20 @@ def get_image_name(path, prefix):
                   right_now.hour, right_now.minute, right_now.second))
     return file_name
 
+#------------------------------------------------------------------------------
+def save_jpeg(filename, image, jpeg=None):
+    """
+    Write jpeg bytes from the camera as is if available,
+    otherwise encode image at JPEG_QUALITY
+    """
+    if jpeg is None:
+        retval, buf = cv2.imencode(".jpg", image,
+                                   [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        jpeg = buf.tobytes()
+    f = open(filename, 'wb')
+    f.write(jpeg)
+    f.close()
+
 #------------------------------------------------------------------------------
 def log_to_csv_file(data_to_append):
     """ create log file if required and save data to csv file """
@@ -373,17 +1694,20 @@ def crossed_y_centerline(enter, leave, movelist):
     return enter, leave, movelist
 
 #------------------------------------------------------------------------------
-def track():
-    """ Track Movement and count enter, leave """
-    image1 = vs.read()   # initialize image1 (done once)
-    try:
-        grayimage1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-    except:
+def track(enter=0, leave=0):
+    """
+    Track Movement and count enter, leave.  Returns enter, leave counts
+    when the camera stream stalls so they carry over after a restart.
+    """
+    global PROG_START
+    image1, frame_time = vs.read_timed()   # initialize image1 (done once)
+    if image1 is None:
         vs.stop()
         print("Problem Connecting To Camera Stream.")
-        print("Restarting Camera.  One Moment Please .....")
-        time.sleep(4)
-        return
+        return enter, leave
+    grayimage1 = gray_frame(image1)
+    if RECORD_ON:
+        recorder.add(grayimage1 if RECORD_GRAY else image1.copy(), frame_time)
     if WINDOW_ON:
         print("Press q in window Quits")
     else:
@@ -391,29 +1715,25 @@ def track():
     print("Start Tracking Enter Leave Activity ....")
     if not VERBOSE:
         print("Note: Console Messages Suppressed per VERBOSE=%s" % VERBOSE)
-    big_w = int(CAMERA_WIDTH * WINDOW_BIGGER)
-    big_h = int(CAMERA_HEIGHT * WINDOW_BIGGER)
     cx, cy, cw, ch = 0, 0, 0, 0   # initialize contour center variables
     frame_count = 0  #initialize for show_loop_fps
     start_time = time.time() #initialize for show_loop_fps
     still_scanning = True
     movelist = []
-    move_time = time.time()
-    enter = 0
-    leave = 0
+    move_time = frame_time  # camera frame times so replays run at any speed
 
-    if DEVICE_CONTROL_ON:
-        # Initialize variables if Using Device Control option
-        light_timer = LIGHT_TIMER
-        green_time = datetime.datetime.now() + light_timer
-        logging.info("light_timer = %i", light_timer)
-        servo_open = True
-        led_green(True)
     while still_scanning:
+        if vs.stalled(STREAM_STALL_TIMEOUT):
+            logging.warning("No camera frame for %.1f sec. Restarting Camera",
+                            STREAM_STALL_TIMEOUT)
+            bus.publish("health", status="stalled",
+                        seconds=STREAM_STALL_TIMEOUT)
+            vs.stop()
+            return enter, leave
+        occupancy.check_reset()
         # initialize variables
         motion_found = False
-        biggest_area = MIN_AREA
-        image2 = vs.read()  # initialize image2
+        image2, frame_time = vs.read_timed()  # initialize image2
         if WEBCAM:
             if (WEBCAM_HFLIP and WEBCAM_VFLIP):
                 image2 = cv2.flip(image2, -1)
@@ -421,179 +1741,187 @@ def track():
                 image2 = cv2.flip(image2, 1)
             elif WEBCAM_VFLIP:
                 image2 = cv2.flip(image2, 0)
-        if WINDOW_ON:
-            if CENTER_LINE_VERT:
-                cv2.line(image2, (X_CENTER, 0), (X_CENTER, Y_MAX), COLOR_TEXT, 2)
-            else:
-                cv2.line(image2, (0, Y_CENTER), (X_MAX, Y_CENTER), COLOR_TEXT, 2)
-        grayimage2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+        grayimage2 = gray_frame(image2)
+        if RECORD_ON:
+            recorder.add(grayimage2 if RECORD_GRAY else image2.copy(), frame_time)
         # Get differences between the two greyed images
-        difference_image = cv2.absdiff(grayimage1, grayimage2)
+        difference_image = backend.absdiff(grayimage1, grayimage2)
         # save grayimage2 to grayimage1 ready for next image2
+        prev_grayimage = grayimage1   # kept for FLOW_CONFIRM_ON
         grayimage1 = grayimage2
-        difference_image = cv2.blur(difference_image, (BLUR_SIZE, BLUR_SIZE))
+        difference_image = backend.blur(difference_image, BLUR_SIZE)
         # Get threshold of difference image based on
         # THRESHOLD_SENSITIVITY variable
-        retval, thresholdimage = cv2.threshold(difference_image,
-                                               THRESHOLD_SENSITIVITY, 255,
-                                               cv2.THRESH_BINARY)
-        # Try python2 opencv syntax and fail over to
-        # python3 opencv syntax if required
-        try:
-            contours, hierarchy = cv2.findContours(thresholdimage,
-                                                   cv2.RETR_EXTERNAL,
-                                                   cv2.CHAIN_APPROX_SIMPLE)
-        except ValueError:
-            thresholdimage, contours, hierarchy = cv2.findContours(thresholdimage,
-                                                                   cv2.RETR_EXTERNAL,
-                                                                   cv2.CHAIN_APPROX_SIMPLE)
-        if contours:
-            total_contours = len(contours)  # Get total number of contours
-            for c in contours:              # find contour with biggest area
-                found_area = cv2.contourArea(c)  # get area of next contour
-                # find the middle of largest bounding rectangle
-                if found_area > biggest_area:
-                    motion_found = True
-                    biggest_area = found_area
-                    (x, y, w, h) = cv2.boundingRect(c)
-                    cx = int(x + w/2)   # put circle in middle of width
-                    cy = int(y + h/2)   # put circle in middle of height
-                    cw, ch = w, h
-            if motion_found:
-                move_timer = time.time() - move_time
-                if move_timer >= MOVE_LIST_TIMEOUT:
-                    movelist = []
-                    #logging.info("Exceeded %.2f Seconds - Clear movelist" % MOVE_LIST_TIMEOUT)
-                move_time = time.time()
-                old_enter = enter
-                old_leave = leave
-                if CENTER_LINE_VERT:
-                    movelist.append(cx)
-                    enter, leave, movelist = crossed_x_centerline(enter, leave, movelist)
-                else:
-                    movelist.append(cy)
-                    enter, leave, movelist = crossed_y_centerline(enter, leave, movelist)
-                if not movelist:
-                    if enter > old_enter:
-                        if INOUT_REVERSE:   # reverse enter leave if required
-                            prefix = "leave"
-                        else:
-                            prefix = "enter"
-                    elif leave > old_leave:
-                        if INOUT_REVERSE:
-                            prefix = enter
-                        else:
-                            prefix = "leave"
+        thresholdimage = backend.threshold(difference_image,
+                                           THRESHOLD_SENSITIVITY)
+        # Find the biggest moving area with an area over MIN_AREA
+        total_contours, biggest_area, box = backend.biggest_blob(thresholdimage,
+                                                                 MIN_AREA)
+        if box is not None:
+            motion_found = True
+            (x, y, cw, ch) = box
+            cx = x + cw // 2   # put circle in middle of width
+            cy = y + ch // 2   # put circle in middle of height
+            bus.publish("track", x=cx, y=cy, w=cw, h=ch,
+                        area=biggest_area)
+            move_timer = frame_time - move_time
+            if move_timer >= MOVE_LIST_TIMEOUT:
+                movelist = []
+                #logging.info("Exceeded %.2f Seconds - Clear movelist" % MOVE_LIST_TIMEOUT)
+            move_time = frame_time
+            old_enter = enter
+            old_leave = leave
+            if CENTER_LINE_VERT:
+                movelist.append(cx)
+                enter, leave, movelist = crossed_x_centerline(enter, leave, movelist)
+            else:
+                movelist.append(cy)
+                enter, leave, movelist = crossed_y_centerline(enter, leave, movelist)
+            crossed = not movelist
+            if crossed and FLOW_CONFIRM_ON:
+                # Only candidate crossings pay for the optical flow check
+                crossed = flow.confirm(prev_grayimage, grayimage2,
+                                       (x, y, cw, ch), enter > old_enter)
+                if not crossed:
+                    # The blob is not moving the counted way.  Restart
+                    # its move list here so it can be counted later
+                    enter, leave = old_enter, old_leave
+                    movelist = [cx] if CENTER_LINE_VERT else [cy]
+            if crossed:
+                if enter > old_enter:
+                    if INOUT_REVERSE:   # reverse enter leave if required
+                        prefix = "leave"
                     else:
-                        prefix = "error"
-                    # Control device or devices base on counters
-                    # for in and out. You can reset counter from
-                    # the control_device function and reset the
-                    # counters based on your control_device logic
-                    if DEVICE_CONTROL_ON:
-                        if timer_on(green_time, light_timer):
-                            enter = 0  # Reset enter counter
-                            leave = 0  # Reset leave counter
-                            # Toggle Servo position
-                            servo_open = control_servo(servo_open)
-                            if enter > 3 or leave > 3:
-                                light_timer = light_timer - 1
-                                if light_timer < 10:
-                                    logging.info("light_timer is at min value")
-                                    light_timer = 10
-                                logging.info("Changed light_timer to %i sec",
-                                             light_timer)
-                            green_time = datetime.datetime.now() + light_timer
+                        prefix = "enter"
+                elif leave > old_leave:
                     if INOUT_REVERSE:
-                        logging.info("leave=%i enter=%i Diff=%i",
-                                     leave, enter, abs(enter-leave))
-                    else:
-                        logging.info("enter=%i leave=%i Diff=%i",
-                                     enter, leave, abs(enter-leave))
-                    # Save image
-                    if SAVE_IMAGES:
-                        filename = get_image_name(IMAGE_PATH, prefix)
-                        save_image = vs.read()
-                        logging.info("Save: %s", filename)
-                        cv2.imwrite(filename, save_image)
-                    # Save data to csv file
-                    if SAVE_CSV_FILE:
-                        log_time = datetime.datetime.now()
-                        log_csv_time = ("%s%04d%02d%02d%s,%s%02d%s,%s%02d%s,%s%02d%s" %
-                                        (QUOTE, log_time.year, log_time.month,
-                                         log_time.day, QUOTE,
-                                         QUOTE, log_time.hour, QUOTE,
-                                         QUOTE, log_time.minute, QUOTE,
-                                         QUOTE, log_time.second, QUOTE))
-                        log_csv_text = ("%s,%s%s%s,%s%s%s,%i,%i,%i,%i,%i" %
-                                        (log_csv_time,
-                                         QUOTE, prefix, QUOTE,
-                                         QUOTE, filename, QUOTE,
-                                         cx, cy, cw, ch, cw * ch))
-                        log_to_csv_file(log_csv_text)
-                if WINDOW_ON:
-                    # show small circle at motion location
-                    if SHOW_CIRCLE and motion_found:
-                        cv2.circle(image2, (cx, cy), CIRCLE_SIZE,
-                                   COLOR_MO, LINE_THICKNESS)
+                        prefix = "enter"
                     else:
-                        cv2.rectangle(image2, (cx, cy), (x+cw, y+ch),
-                                      COLOR_MO, LINE_THICKNESS)
-                if SHOW_MOVES:
-                    logging.info("cx,cy(%i,%i) C:%2i A:%ix%i=%i SqPx" %
-                                 (cx, cy, total_contours,
-                                  cw, ch, biggest_area))
+                        prefix = "leave"
+                else:
+                    prefix = "error"
+                # Control device or devices based on crossings.
+                # See DeviceController for the servo and light logic
+                if DEVICE_CONTROL_ON:
+                    device.crossing()
+                occupied = occupancy.update(prefix == "enter")
+                if INOUT_REVERSE:
+                    logging.info("leave=%i enter=%i Diff=%i Occupancy=%.1f",
+                                 leave, enter, abs(enter-leave), occupied)
+                else:
+                    logging.info("enter=%i leave=%i Diff=%i Occupancy=%.1f",
+                                 enter, leave, abs(enter-leave), occupied)
+                # Save image
+                filename = ""
+                if SAVE_IMAGES:
+                    filename = get_image_name(IMAGE_PATH, prefix)
+                    logging.info("Save: %s", filename)
+                    save_jpeg(filename, vs.read(), vs.read_jpeg())
+                # Save data to csv file
+                if SAVE_CSV_FILE:
+                    log_time = datetime.datetime.now()
+                    log_csv_time = ("%s%04d%02d%02d%s,%s%02d%s,%s%02d%s,%s%02d%s" %
+                                    (QUOTE, log_time.year, log_time.month,
+                                     log_time.day, QUOTE,
+                                     QUOTE, log_time.hour, QUOTE,
+                                     QUOTE, log_time.minute, QUOTE,
+                                     QUOTE, log_time.second, QUOTE))
+                    log_csv_text = ("%s,%s%s%s,%s%s%s,%i,%i,%i,%i,%i" %
+                                    (log_csv_time,
+                                     QUOTE, prefix, QUOTE,
+                                     QUOTE, filename, QUOTE,
+                                     cx, cy, cw, ch, cw * ch))
+                    log_to_csv_file(log_csv_text)
+                if INOUT_REVERSE:
+                    bus.publish("crossing", direction=prefix,
+                                enter=leave, leave=enter,
+                                occupancy=occupied, image=filename,
+                                x=cx, y=cy, w=cw, h=ch,
+                                frame_time=frame_time)
+                else:
+                    bus.publish("crossing", direction=prefix,
+                                enter=enter, leave=leave,
+                                occupancy=occupied, image=filename,
+                                x=cx, y=cy, w=cw, h=ch,
+                                frame_time=frame_time)
+            if SHOW_MOVES:
+                logging.info("cx,cy(%i,%i) C:%2i A:%ix%i=%i SqPx" %
+                             (cx, cy, total_contours,
+                              cw, ch, biggest_area))
+        if PROG_START:
+            # print so it is shown whatever the VERBOSE and SAVE_LOG settings
+            print("First frame processed %.2f sec after launch"
+                  % (time.time() - PROG_START))
+            PROG_START = 0  # Only report once per launch
         start_time, frame_count = show_loop_fps(start_time, frame_count)
-        if WINDOW_ON:
-            if INOUT_REVERSE:
-                img_text = ("LEAVE %i          ENTER %i" % (leave, enter))
-            else:
-                img_text = ("ENTER %i          LEAVE %i" % (enter, leave))
-            cv2.putText(image2, img_text, (35, 15),
-                        TEXT_FONT, FONT_SCALE, (COLOR_TEXT), 1)
-            if DIFF_WINDOW_ON:
-                cv2.imshow('Difference Image', difference_image)
-            if THRESH_WINDOW_ON:
-                cv2.imshow('OpenCV Threshold', thresholdimage)
-            # Note setting a bigger window will slow the FPS
-            if WINDOW_BIGGER > 1:
-                image3 = cv2.resize(image2, (big_w, big_h))
-            cv2.imshow('Press q in Window Quits)', image3)
-            # Close Window if q pressed while mouse in opencv gui window
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                cv2.destroyAllWindows()
-                vs.stop()
-                print("End Motion Tracking")
-                quit(0)
+        # Overlays are drawn on a copy by the display stage, if anything
+        # is attached, so image2 is left as captured
+        display.submit(image2, difference_image, thresholdimage, enter, leave,
+                       (x, y, cw, ch) if motion_found else None)
+        if window is not None:
+            window.show()
+        if display.quit.is_set():
+            # Return so __main__ stops the recorder, devices and spool
+            print("End Motion Tracking")
+            return enter, leave
 
 #------------------------------------------------------------------------------
 if __name__ == '__main__':
+    vs = None
+    bus = EventBus()
+    if EVENT_SOCKET_ON:
+        EventSocketServer(bus).start()
+    occupancy = Occupancy()
+    flow = FlowConfirm()
+    display = DisplayStage().start()
+    window = None
+    if WINDOW_ON:
+        window = WindowOutput(display)
+        display.attach(window)
+    if DISPLAY_MJPEG_ON:
+        MjpegOutput(display).start()
+    spool = None
+    if SPOOL_ON:
+        spool = EventSpool(bus).start()
+    if RECORD_ON:
+        recorder = SessionRecorder().start()
+    device = None
+    if DEVICE_CONTROL_ON:
+        if DEVICE_SIMULATE:
+            device = DeviceController(SimulatedDevices()).start()
+        else:
+            device = DeviceController(GpioDevices()).start()
+    enter, leave = 0, 0
+    restarts = 0
     try:
         while True:
-            # Save images to an in-program stream
             # Setup video stream on a processor Thread for faster speed
-            if WEBCAM:   #  Start Web Cam stream (Note USB webcam must be plugged in)
-                print("Initializing USB Web Camera ....")
-                vs = WebcamVideoStream().start()
-                vs.CAM_SRC = WEBCAM_SRC
-                vs.CAM_WIDTH = WEBCAM_WIDTH
-                vs.CAM_HEIGHT = WEBCAM_HEIGHT
-                time.sleep(4.0)  # Allow WebCam to initialize
-            else:
-                print("Initializing Pi Camera ....")
-                vs = PiVideoStream().start()
-                vs.camera.rotation = CAMERA_ROTATION
-                vs.camera.hflip = CAMERA_HFLIP
-                vs.camera.vflip = CAMERA_VFLIP
-                time.sleep(2.0)  # Allow PiCamera to initialize
-            track()
+            # and restart it whenever track() reports a stalled stream
+            vs = start_stream(vs)
+            if restarts:
+                # Recovery time is measured from the last good frame
+                logging.info("Camera recovered in %.2f sec (restart %i)",
+                             vs.frame_time - stall_time, restarts)
+            enter, leave = track(enter, leave)
+            if display.quit.is_set():
+                break   # q pressed in the window
+            stall_time = vs.frame_time
+            restarts += 1
     except KeyboardInterrupt:
         pass
-    vs.stop()
-    if DEVICE_CONTROL_ON:
-        p.stop()
-        GPIO.cleanup()
+    if vs is not None:
+        vs.stop()
+    if device is not None:
+        device.stop()
+    if RECORD_ON:
+        recorder.stop()
+    if spool is not None:
+        spool.stop()
+    display.stop()
     print("")
-    print("User Pressed Keyboard ctrl-c")
+    if display.quit.is_set():
+        print("User Pressed q in Window")
+    else:
+        print("User Pressed Keyboard ctrl-c")
     print("%s %s - Exiting" % (PROG_NAME, PROG_VER))
     quit(0)
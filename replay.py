@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+replay.py - Replay inout.py session recordings through track()
+
+Set RECORD_ON = True in config.py and inout.py records the frames it
+processes, with their frame times, to chunk files in RECORD_PATH.
+This script runs those frames back through inout.track() with the
+current config.py settings and reports the enter and leave counts.
+With RECORD_SCALE = 1.0 a replay gives exactly the same counts as the
+live session, so field miscounts can be reproduced and settings tried.
+
+How to Run
+
+    cd ~/track-inout
+    ./replay.py media/recordings
+    ./replay.py media/recordings/rec-20261019-101500-000000.rec
+
+"""
+PROG_VER = "ver 1.0"
+import argparse
+import os
+import inout
+
+PROG_NAME = os.path.basename(__file__)
+
+#------------------------------------------------------------------------------
+def main():
+    """ Replay recording files or folders in time order """
+    parser = argparse.ArgumentParser(
+        description="Replay inout.py recordings through track()")
+    parser.add_argument("recordings", nargs="+",
+                        help="recording .rec files or folders of them")
+    args = parser.parse_args()
+
+    filenames = []
+    for recording in args.recordings:
+        if os.path.isdir(recording):
+            filenames.extend(sorted([os.path.join(recording, name)
+                                     for name in os.listdir(recording)
+                                     if name.endswith(".rec")]))
+        else:
+            filenames.append(recording)
+    if not filenames:
+        print("No recordings found in %s" % " ".join(args.recordings))
+        return
+    print("%s %s Replaying %i recording files" % (PROG_NAME, PROG_VER,
+                                                  len(filenames)))
+
+    # Recorded frames are already flipped. Replay without side effects
+    inout.WEBCAM_HFLIP = False
+    inout.WEBCAM_VFLIP = False
+    inout.WINDOW_ON = False
+    inout.SAVE_IMAGES = False
+    inout.SAVE_CSV_FILE = False
+    inout.DEVICE_CONTROL_ON = False
+    inout.RECORD_ON = False
+
+    stream = inout.RecordedVideoStream(filenames)
+    height, width = stream.frames.shape[1:3]
+    inout.X_CENTER, inout.Y_CENTER = width // 2, height // 2
+    inout.X_MAX, inout.Y_MAX = width, height
+    inout.X_BUF = int(width / inout.BUFFER_SETTING)
+    inout.Y_BUF = int(height / inout.BUFFER_SETTING)
+    inout.vs = stream
+    inout.bus = inout.EventBus()
+    inout.occupancy = inout.Occupancy(reset_times=[], learn_rate=0.0)
+    inout.display = inout.DisplayStage()   # nothing attached so nothing drawn
+    inout.window = None
+    inout.flow = inout.FlowConfirm()
+    enter, leave = inout.track()
+    if inout.INOUT_REVERSE:
+        enter, leave = leave, enter
+    print("Replayed %i frames  enter=%i leave=%i"
+          % (stream.frame_number, enter, leave))
+
+if __name__ == '__main__':
+    main()
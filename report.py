@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+report.py - Batch analytics for track-inout csv event logs
+
+Reads one or more inout.csv files produced by inout.py SAVE_CSV_FILE=True
+and reports occupancy over time, busiest hours of the day, an estimated
+dwell time and a side by side comparison of each camera (one log file
+per camera or site).
+
+Logs are read in chunks of lines and each chunk is parsed with numpy,
+so memory use does not grow with log file size.  Only per hour totals
+are kept between chunks.
+
+How to Run
+
+    cd ~/track-inout
+    ./report.py inout.csv
+    ./report.py --hourly site1=site1/inout.csv site2=site2/inout.csv.gz
+
+"""
+PROG_VER = "ver 1.0"
+import argparse
+import datetime
+import gzip
+import io
+import itertools
+import os
+import numpy as np
+
+PROG_NAME = os.path.basename(__file__)
+CHUNK_LINES = 100000  # default lines parsed per numpy chunk
+
+#------------------------------------------------------------------------------
+def open_csv(path):
+    """ open a plain inout.py csv log """
+    return io.open(path, "r")
+
+#------------------------------------------------------------------------------
+def open_csv_gz(path):
+    """ open a gzip compressed inout.py csv log """
+    return io.TextIOWrapper(gzip.open(path, "rb"))
+
+# Log readers by file name ending.  Add an entry here for new log formats.
+# Each opener returns a text stream of inout.py csv lines.
+LOG_OPENERS = [(".csv.gz", open_csv_gz),
+               (".csv", open_csv)]
+
+#------------------------------------------------------------------------------
+def read_chunks(path, chunk_lines=CHUNK_LINES):
+    """
+    Yield (bucket, hour, enter, leave) numpy arrays for each chunk
+    of a log file. bucket is YYYYMMDDHH, hour is hour of day and
+    enter and leave are 0 or 1 for each event
+    """
+    for ending, opener in LOG_OPENERS:
+        if path.endswith(ending):
+            break
+    else:
+        raise ValueError("No log reader for %s" % path)
+    with opener(path) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_lines))
+            if not lines:
+                return
+            text = "".join(lines).replace('"', '')
+            # columns are date, hour, minute, second, prefix, filename ...
+            cols = np.loadtxt(io.StringIO(text), delimiter=",", dtype=str,
+                              usecols=(0, 1, 4), ndmin=2)
+            hour = cols[:, 1].astype(np.int64)
+            bucket = cols[:, 0].astype(np.int64) * 100 + hour
+            enter = (cols[:, 2] == "enter").astype(np.int64)
+            leave = (cols[:, 2] == "leave").astype(np.int64)
+            yield bucket, hour, enter, leave
+
+#------------------------------------------------------------------------------
+class LogStats:
+    """ Running totals for one camera log """
+    def __init__(self, name, reset_hour=0):
+        self.name = name
+        self.reset_hour = reset_hour   # hour of day occupancy starts from zero
+        self.buckets = {}   # YYYYMMDDHH: [enter, leave]
+        self.hour_enter = np.zeros(24, dtype=np.int64)
+        self.hour_leave = np.zeros(24, dtype=np.int64)
+
+    def add(self, bucket, hour, enter, leave):
+        """ merge one parsed chunk into the running totals """
+        self.hour_enter += np.bincount(hour, weights=enter,
+                                       minlength=24).astype(np.int64)
+        self.hour_leave += np.bincount(hour, weights=leave,
+                                       minlength=24).astype(np.int64)
+        keys, index = np.unique(bucket, return_inverse=True)
+        enters = np.bincount(index, weights=enter).astype(np.int64)
+        leaves = np.bincount(index, weights=leave).astype(np.int64)
+        for key, key_enter, key_leave in zip(keys.tolist(), enters.tolist(),
+                                             leaves.tolist()):
+            totals = self.buckets.setdefault(key, [0, 0])
+            totals[0] += key_enter
+            totals[1] += key_leave
+
+    def occupancy(self):
+        """
+        Return every hour bucket from the first to the last logged hour,
+        enter and leave counts per bucket and the occupancy at end of each
+        hour.  Hours with no events are filled in with zero counts.
+        Occupancy is enter minus leave since reset_hour that day, clamped
+        at zero, so missed counts do not pile up over long logs
+        """
+        keys, counts, running = [], [], []
+        if self.buckets:
+            hour = datetime.datetime.strptime(str(min(self.buckets)), "%Y%m%d%H")
+            last = datetime.datetime.strptime(str(max(self.buckets)), "%Y%m%d%H")
+            occupied = 0
+            while hour <= last:
+                key = int(hour.strftime("%Y%m%d%H"))
+                if hour.hour == self.reset_hour:
+                    occupied = 0
+                key_enter, key_leave = self.buckets.get(key, (0, 0))
+                occupied = max(0, occupied + key_enter - key_leave)
+                keys.append(key)
+                counts.append((key_enter, key_leave))
+                running.append(occupied)
+                hour += datetime.timedelta(hours=1)
+        counts = np.array(counts, dtype=np.int64).reshape(-1, 2)
+        return (np.array(keys, dtype=np.int64), counts[:, 0], counts[:, 1],
+                np.array(running, dtype=np.int64))
+
+    def dwell_minutes(self):
+        """
+        Estimate average dwell time using Little's Law.  Average
+        occupancy over the logged hours divided by the enter rate
+        """
+        keys, enter, leave, running = self.occupancy()
+        if not enter.sum():
+            return 0.0
+        average_occupancy = running.mean()
+        enters_per_hour = enter.sum() / float(len(keys))
+        return 60.0 * average_occupancy / enters_per_hour
+
+#------------------------------------------------------------------------------
+def print_hourly(stats):
+    """ print occupancy at the end of each logged hour """
+    keys, enter, leave, running = stats.occupancy()
+    print("")
+    print("%s Occupancy by Hour" % stats.name)
+    print("%-14s %8s %8s %10s" % ("Date Hour", "Enter", "Leave", "Occupancy"))
+    for key, key_enter, key_leave, key_running in zip(keys, enter, leave, running):
+        print("%8i %02i:00 %8i %8i %10i" % (key // 100, key % 100,
+                                           key_enter, key_leave, key_running))
+
+#------------------------------------------------------------------------------
+def print_peak_hours(stats, top=3):
+    """ print the busiest hours of the day by enter plus leave events """
+    busy = stats.hour_enter + stats.hour_leave
+    peaks = np.argsort(busy)[::-1][:top]
+    print("%s Peak Hours: %s" % (stats.name, ", ".join(
+        ["%02i:00 (%i)" % (hour, busy[hour]) for hour in peaks if busy[hour]])))
+
+#------------------------------------------------------------------------------
+def print_compare(all_stats):
+    """ print a side by side summary of each camera log """
+    print("")
+    print("%-20s %10s %10s %10s %10s %10s" % ("Camera", "Enter", "Leave",
+                                               "Net", "Max Occ", "Dwell Min"))
+    for stats in all_stats:
+        keys, enter, leave, running = stats.occupancy()
+        max_occupancy = running.max() if len(running) else 0
+        print("%-20s %10i %10i %10i %10i %10.1f"
+              % (stats.name, enter.sum(), leave.sum(),
+                 enter.sum() - leave.sum(), max_occupancy,
+                 stats.dwell_minutes()))
+
+#------------------------------------------------------------------------------
+def main():
+    """ Parse command line and report on each log file """
+    parser = argparse.ArgumentParser(
+        description="Report on track-inout csv event logs")
+    parser.add_argument("logs", nargs="+", metavar="[NAME=]LOG",
+                        help="inout.py csv log. Optional NAME= labels the camera")
+    parser.add_argument("--hourly", action="store_true",
+                        help="print occupancy for each logged hour")
+    parser.add_argument("--reset-hour", type=int, default=0,
+                        help="hour of day occupancy is reset to zero (default 0)")
+    parser.add_argument("--chunk", type=int, default=CHUNK_LINES,
+                        help="lines parsed per chunk (default %i)" % CHUNK_LINES)
+    args = parser.parse_args()
+
+    print("%s %s" % (PROG_NAME, PROG_VER))
+    all_stats = []
+    for log in args.logs:
+        if "=" in log:
+            name, path = log.split("=", 1)
+        else:
+            name, path = log, log
+        stats = LogStats(name, args.reset_hour)
+        for chunk in read_chunks(path, args.chunk):
+            stats.add(*chunk)
+        all_stats.append(stats)
+        if args.hourly:
+            print_hourly(stats)
+    print("")
+    for stats in all_stats:
+        print_peak_hours(stats)
+    print_compare(all_stats)
+
+if __name__ == '__main__':
+    main()
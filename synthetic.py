@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+synthetic.py - Synthetic scenes for load and accuracy testing of inout.py
+
+SyntheticVideoStream renders moving blobs that cross the center line at
+set speeds, sizes and densities with camera noise and lighting flicker.
+It keeps exact ground truth enter and leave counts and can be used in
+place of WebcamVideoStream by inout.track().  Each read() returns the
+next frame and frame_time follows a simulated camera clock, so results
+do not depend on how fast track() runs.
+
+Run this script to sweep MIN_AREA, BLUR_SIZE and THRESHOLD_SENSITIVITY
+over one or more resolutions and report counting accuracy against
+processing fps.  Use --csv to save the table for charting.
+
+How to Run
+
+    cd ~/track-inout
+    ./synthetic.py --resolutions 320x240,640x480 --min-area 300,700 --blur 5,10
+
+"""
+PROG_VER = "ver 1.0"
+import argparse
+import itertools
+import logging
+import os
+import sys
+import time
+import numpy as np
+import backends
+import inout
+
+PROG_NAME = os.path.basename(__file__)
+
+#------------------------------------------------------------------------------
+class SyntheticVideoStream:
+    """
+    Render blobs crossing the center line.  Object sizes are a fraction
+    of frame height and speeds a fraction of the crossing axis per frame
+    so scenes look the same at any resolution.
+    """
+    def __init__(self, width=320, height=240, frames=1000, density=1.0,
+                 speed=0.02, size=0.25, noise=4.0, flicker=0.0,
+                 vertical=True, gray=False, seed=0, fps=25):
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.noise = noise
+        self.flicker = flicker
+        self.vertical = vertical  # True= blobs move across a vertical center line
+        self.gray = gray
+        self.random = np.random.RandomState(seed)
+        self.frame = None
+        self.frame_number = 0
+        self.fps = float(fps)     # camera frame rate for frame_time clock
+        self.frame_time = 0.0
+        self.render_time = 0.0    # seconds spent rendering, excluded from fps
+        self.enter_truth = 0
+        self.leave_truth = 0
+        self.objects = []         # (start frame, end frame, start, step, lane, texture)
+        length = width if vertical else height
+        across = height if vertical else width
+        starts = self.random.poisson(density / 100.0, frames).nonzero()[0]
+        for start in starts:
+            blob_w = max(2, int(size * height * self.random.uniform(0.7, 1.3)))
+            blob_h = max(2, int(size * height * self.random.uniform(0.7, 1.3)))
+            step = max(1.0, speed * length * self.random.uniform(0.7, 1.3))
+            lane = self.random.randint(0, max(1, across - (blob_h if vertical else blob_w)))
+            travel = length + (blob_w if vertical else blob_h)
+            end = start + int(travel / step)
+            if end >= frames:
+                continue   # Only blobs that finish crossing are rendered
+            if self.random.rand() < 0.5:
+                # Moving toward higher x or y is a leave in inout.py
+                begin = -(blob_w if vertical else blob_h) / 2.0
+                self.leave_truth += 1
+            else:
+                begin = length + (blob_w if vertical else blob_h) / 2.0
+                step = -step
+                self.enter_truth += 1
+            # Textured so frame differences cover the blob, not just its edges
+            texture = self.random.randint(120, 256, (blob_h, blob_w))
+            self.objects.append((start, end, begin, step, lane, texture))
+        # Reuse a few noise frames since random numbers are slow to make
+        self.noise_frames = [self.random.normal(0.0, noise, (height, width))
+                             .astype(np.float32) for _ in range(8)]
+
+    def start(self):
+        """ nothing to start. Frames are rendered on read() """
+        return self
+
+    def render(self, frame_number):
+        """ return gray frame with blobs, noise and flicker """
+        level = 90.0
+        if self.flicker:
+            level += self.flicker * np.sin(frame_number * 0.7)
+        image = np.full((self.height, self.width), level, dtype=np.float32)
+        for start, end, begin, step, lane, texture in self.objects:
+            if start <= frame_number <= end:
+                blob_h, blob_w = texture.shape
+                center = int(begin + step * (frame_number - start))
+                if self.vertical:
+                    x, y = center - blob_w // 2, lane
+                else:
+                    x, y = lane, center - blob_h // 2
+                # clip blob to the frame
+                x1, y1 = max(0, x), max(0, y)
+                x2 = min(self.width, x + blob_w)
+                y2 = min(self.height, y + blob_h)
+                if x1 < x2 and y1 < y2:
+                    image[y1:y2, x1:x2] = texture[y1 - y:y2 - y, x1 - x:x2 - x]
+        if self.noise:
+            image += self.noise_frames[self.random.randint(len(self.noise_frames))]
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        if self.gray:
+            return image
+        return np.dstack((image, image, image))
+
+    def read(self):
+        """ return the next frame """
+        render_start = time.time()
+        self.frame = self.render(min(self.frame_number, self.frames - 1))
+        self.frame_number += 1
+        self.frame_time = self.frame_number / self.fps
+        self.render_time += time.time() - render_start
+        return self.frame
+
+    def read_timed(self):
+        """ return the next (frame, frame_time) pair """
+        frame = self.read()
+        return frame, self.frame_time
+
+    def read_jpeg(self):
+        """ synthetic frames have no camera jpeg """
+        return None
+
+    def wait_ready(self, timeout):
+        """ frames are always ready """
+        return True
+
+    def stalled(self, timeout):
+        """ report a stall once all frames are read so track() returns """
+        return self.frame_number >= self.frames
+
+    def stop(self):
+        """ nothing to stop """
+        return
+
+#------------------------------------------------------------------------------
+def run_scene(stream, min_area, blur_size, threshold, flow_confirm=False,
+              backend="opencv"):
+    """
+    Run inout.track() over a synthetic stream with the given settings.
+    Return enter, leave counts, processing fps and a list of
+    (frame number, direction) for each counted crossing.  inout.flow
+    has the optical flow check counts and time
+    """
+    width, height = stream.width, stream.height
+    inout.MIN_AREA = min_area
+    inout.BLUR_SIZE = blur_size
+    inout.THRESHOLD_SENSITIVITY = threshold
+    inout.FLOW_CONFIRM_ON = flow_confirm
+    inout.backend = backends.get_backend(backend)
+    inout.CENTER_LINE_VERT = stream.vertical
+    inout.X_CENTER, inout.Y_CENTER = width // 2, height // 2
+    inout.X_MAX, inout.Y_MAX = width, height
+    inout.X_BUF = int(width / inout.BUFFER_SETTING)
+    inout.Y_BUF = int(height / inout.BUFFER_SETTING)
+    inout.vs = stream
+    # Big enough queue for every track event so none are dropped
+    inout.bus = inout.EventBus(queue_size=10 * stream.frames)
+    events = inout.bus.subscribe()
+    inout.occupancy = inout.Occupancy(reset_times=[], learn_rate=0.0)
+    inout.flow = inout.FlowConfirm()
+    inout.display = inout.DisplayStage()   # nothing attached so nothing drawn
+    inout.window = None
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # hide track() start messages
+    start_time = time.time()
+    try:
+        enter, leave = inout.track()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    duration = time.time() - start_time - stream.render_time
+    crossings = []
+    while not events.empty():
+        event = events.get()
+        if event["type"] == "crossing":
+            crossings.append((int(round(event["frame_time"] * stream.fps)),
+                              event["direction"]))
+    return enter, leave, stream.frames / max(duration, 1e-6), crossings
+
+#------------------------------------------------------------------------------
+def accuracy(stream, enter, leave):
+    """ 1.0 when counts match ground truth. Each miscount takes away """
+    truth = stream.enter_truth + stream.leave_truth
+    error = abs(enter - stream.enter_truth) + abs(leave - stream.leave_truth)
+    if not truth:
+        return 1.0 if not error else 0.0
+    return max(0.0, 1.0 - error / float(truth))
+
+#------------------------------------------------------------------------------
+def match_crossings(stream, crossings):
+    """
+    Match each counted crossing to a blob moving that way that was in
+    view at the time.  Totals can hide a false count behind a missed one,
+    so return false counts and missed blobs
+    """
+    unmatched = list(stream.objects)
+    false_count = 0
+    for frame_number, direction in crossings:
+        for obj in unmatched:
+            start, end, begin, step = obj[:4]
+            if (start <= frame_number <= end and
+                    (step < 0) == (direction == "enter")):
+                unmatched.remove(obj)
+                break
+        else:
+            false_count += 1
+    return false_count, len(unmatched)
+
+#------------------------------------------------------------------------------
+def int_list(text):
+    """ argparse type for comma separated integers """
+    return [int(value) for value in text.split(",")]
+
+#------------------------------------------------------------------------------
+def main():
+    """ Sweep opencv settings over synthetic scenes """
+    parser = argparse.ArgumentParser(
+        description="Sweep inout.py settings over synthetic scenes")
+    parser.add_argument("--resolutions", default="320x240",
+                        help="comma separated WxH list (default 320x240)")
+    parser.add_argument("--min-area", type=int_list, default=[inout.MIN_AREA])
+    parser.add_argument("--blur", type=int_list, default=[inout.BLUR_SIZE])
+    parser.add_argument("--threshold", type=int_list,
+                        default=[inout.THRESHOLD_SENSITIVITY])
+    parser.add_argument("--backend", default=inout.BACKEND,
+                        help="comma separated backends eg opencv,numpy")
+    parser.add_argument("--flow", default="off",
+                        help="optical flow crossing check off, on or off,on")
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--density", type=float, default=1.0,
+                        help="average new blobs per 100 frames")
+    parser.add_argument("--speed", type=float, default=0.02,
+                        help="fraction of frame crossed per frame")
+    parser.add_argument("--size", type=float, default=0.25,
+                        help="blob size as a fraction of frame height")
+    parser.add_argument("--noise", type=float, default=4.0,
+                        help="gaussian camera noise std dev")
+    parser.add_argument("--flicker", type=float, default=0.0,
+                        help="lighting flicker amplitude")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--csv", help="save results to this csv file")
+    args = parser.parse_args()
+
+    # Keep sweeps quiet and free of side effects
+    logging.getLogger().setLevel(logging.ERROR)
+    inout.WINDOW_ON = False
+    inout.SAVE_IMAGES = False
+    inout.SAVE_CSV_FILE = False
+    inout.DEVICE_CONTROL_ON = False
+    inout.INOUT_REVERSE = False
+    inout.RECORD_ON = False
+
+    print("%s %s" % (PROG_NAME, PROG_VER))
+    header = ("Backend", "Resolution", "MinArea", "Blur", "Thresh", "Flow",
+              "Enter", "Leave", "TruthE", "TruthL", "Accuracy", "False",
+              "Missed", "FPS", "Checks", "Rejects", "ms/Check")
+    print("%-7s %-10s %7s %5s %6s %4s %6s %6s %6s %6s %8s %5s %6s %8s %6s %7s %8s"
+          % header)
+    rows = []
+    for resolution in args.resolutions.split(","):
+        width, height = [int(value) for value in resolution.split("x")]
+        for backend, min_area, blur_size, threshold, flow in itertools.product(
+                args.backend.split(","), args.min_area, args.blur,
+                args.threshold, args.flow.split(",")):
+            stream = SyntheticVideoStream(
+                width, height, args.frames, args.density, args.speed,
+                args.size, args.noise, args.flicker,
+                vertical=inout.CENTER_LINE_VERT,
+                gray=inout.GRAY_CAPTURE_ON, seed=args.seed)
+            enter, leave, fps, crossings = run_scene(
+                stream, min_area, blur_size, threshold, flow == "on", backend)
+            false_count, missed = match_crossings(stream, crossings)
+            checks = inout.flow.checks
+            row = (backend, resolution, min_area, blur_size, threshold, flow, enter,
+                   leave, stream.enter_truth, stream.leave_truth,
+                   accuracy(stream, enter, leave), false_count, missed, fps,
+                   checks, inout.flow.rejected,
+                   1000.0 * inout.flow.seconds / max(checks, 1))
+            rows.append(row)
+            print("%-7s %-10s %7i %5i %6i %4s %6i %6i %6i %6i %8.3f %5i %6i %8.1f"
+                  " %6i %7i %8.3f" % row)
+    if args.csv:
+        with open(args.csv, "w") as f:
+            f.write(",".join(header) + "\n")
+            for row in rows:
+                f.write("%s,%s,%i,%i,%i,%s,%i,%i,%i,%i,%.4f,%i,%i,%.2f,%i,%i,%.4f\n"
+                        % row)
+        print("Saved %s" % args.csv)
+
+if __name__ == '__main__':
+    main()
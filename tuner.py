@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+tuner.py - Search inout.py settings against recorded footage
+
+Replays recorded video files with known enter and leave counts and
+searches MIN_AREA, THRESHOLD_SENSITIVITY, BLUR_SIZE, BUFFER_SETTING and
+MOVE_LIST_TIMEOUT for the best counting accuracy per frame of CPU time.
+
+Shared stages are only computed once.  Each video is decoded and its gray
+difference frames cached to disk.  Each blur size is applied once per
+video, and the biggest contour found for each threshold is kept.  The
+MIN_AREA, BUFFER_SETTING and MOVE_LIST_TIMEOUT candidates then only
+replay the crossing logic.  Stages run in parallel across cores.
+
+The labels file has one video per line.  A video can be a video file or
+an inout.py recording .rec file or folder of them (see RECORD_ON)
+
+    # video, enter, leave
+    media/videos/front-door.avi,12,9
+    media/recordings,30,28
+
+How to Run
+
+    cd ~/track-inout
+    ./tuner.py labels.csv --blur 5,10,15 --threshold 15,25,35
+
+"""
+PROG_VER = "ver 1.0"
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+import cv2
+import numpy as np
+import inout
+
+PROG_NAME = os.path.basename(__file__)
+
+#------------------------------------------------------------------------------
+def read_labels(path):
+    """ return list of (video, enter, leave) from a labels file """
+    labels = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            video, enter, leave = [value.strip() for value in line.split(",")]
+            labels.append((video, int(enter), int(leave)))
+    return labels
+
+#------------------------------------------------------------------------------
+def read_frames(video):
+    """
+    Yield (frame, frame time) for each frame of a video file, or of an
+    inout.py recording .rec file or folder of them.  Recordings use their
+    recorded frame times, video files the frame number over fps
+    """
+    if os.path.isdir(video) or video.endswith(".rec"):
+        if os.path.isdir(video):
+            filenames = sorted([os.path.join(video, name)
+                                for name in os.listdir(video)
+                                if name.endswith(".rec")])
+        else:
+            filenames = [video]
+        for filename in filenames:
+            times, frames = inout.read_recording(filename)
+            for frame, frame_time in zip(frames, times):
+                yield np.array(frame), float(frame_time)
+        return
+    capture = cv2.VideoCapture(video)
+    fps = capture.get(cv2.CAP_PROP_FPS) or inout.CAMERA_FRAMERATE
+    count = 0
+    while True:
+        grabbed, image = capture.read()
+        if not grabbed:
+            break
+        yield image, count / fps
+        count += 1
+    capture.release()
+
+#------------------------------------------------------------------------------
+def cache_diffs(video, cache_dir):
+    """
+    Decode video once and save its gray difference frames to a numpy
+    file in cache_dir.  Returns (cache path, frame times, seconds per frame)
+    """
+    name = video.rstrip(os.sep).replace(os.sep, "_").lstrip(".")
+    diff_path = os.path.join(cache_dir, name + "-diff.npy")
+    times_path = os.path.join(cache_dir, name + "-times.npy")
+    cost_path = os.path.join(cache_dir, name + "-cost.npy")
+    if (os.path.exists(diff_path) and
+            os.path.getmtime(diff_path) > os.path.getmtime(video)):
+        return diff_path, np.load(times_path), float(np.load(cost_path))
+    frames = read_frames(video)
+    try:
+        image, first_time = next(frames)
+    except StopIteration:
+        raise IOError("Could not read video %s" % video)
+    gray1 = inout.gray_frame(image)
+    # Frame counts reported by containers and streams can be 0, -1 or
+    # wrong, so frames are appended to a raw file until the video ends
+    times = []
+    cost = 0.0
+    count = 0
+    with open(diff_path + ".raw", "wb") as raw:
+        for image, frame_time in frames:
+            start = time.time()
+            gray2 = inout.gray_frame(image)
+            difference_image = inout.backend.absdiff(gray1, gray2)
+            cost += time.time() - start
+            raw.write(difference_image.tobytes())
+            gray1 = gray2
+            count += 1
+            times.append(frame_time - first_time)
+    if not count:
+        os.remove(diff_path + ".raw")
+        raise IOError("Video %s has only one frame" % video)
+    times = np.array(times)
+    np.save(times_path, times)
+    np.save(cost_path, cost / count)
+    # Add a numpy header now the frame count is known.  The diff file is
+    # written last so a partly cached video is never used
+    with open(diff_path + ".part", "wb") as f:
+        np.lib.format.write_array_header_1_0(
+            f, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+                "fortran_order": False, "shape": (count,) + gray1.shape})
+        with open(diff_path + ".raw", "rb") as raw:
+            shutil.copyfileobj(raw, f, 1024 * 1024)
+    os.remove(diff_path + ".raw")
+    os.rename(diff_path + ".part", diff_path)
+    return diff_path, times, cost / count
+
+#------------------------------------------------------------------------------
+def detect(diff_path, frames, blur_size, thresholds):
+    """
+    Blur each cached difference frame once and find the biggest contour
+    for every threshold.  Returns {threshold: (detections, seconds per frame)}
+    where detections rows are biggest area, cx, cy per frame
+    """
+    diffs = np.load(diff_path, mmap_mode="r")[:frames]
+    detections = dict((threshold, np.zeros((len(diffs), 3)))
+                      for threshold in thresholds)
+    costs = dict((threshold, 0.0) for threshold in thresholds)
+    blur_cost = 0.0
+    backend = inout.backend
+    for index, difference_image in enumerate(diffs):
+        start = time.time()
+        blurred = backend.blur(difference_image, blur_size)
+        blur_cost += time.time() - start
+        for threshold in thresholds:
+            start = time.time()
+            thresholdimage = backend.threshold(blurred, threshold)
+            # MIN_AREA candidates are applied later by count_crossings()
+            total, area, box = backend.biggest_blob(thresholdimage, 0)
+            if box is not None:
+                (x, y, w, h) = box
+                detections[threshold][index] = (area, x + w // 2, y + h // 2)
+            costs[threshold] += time.time() - start
+    frames = max(len(diffs), 1)
+    return dict((threshold, (detections[threshold],
+                             (blur_cost + costs[threshold]) / frames))
+                for threshold in thresholds)
+
+#------------------------------------------------------------------------------
+def cache_job(job):
+    """ Pool worker for cache_diffs() """
+    return cache_diffs(*job)
+
+#------------------------------------------------------------------------------
+def detect_job(job):
+    """ Pool worker for detect() """
+    video, diff_path, frames, blur_size, thresholds = job
+    return video, blur_size, detect(diff_path, frames, blur_size, thresholds)
+
+#------------------------------------------------------------------------------
+def count_crossings(detections, times, shape, min_area, buffer_setting,
+                    timeout):
+    """
+    Replay track() crossing logic over cached detections.
+    Returns enter, leave counts
+    """
+    height, width = shape
+    inout.X_CENTER, inout.Y_CENTER = width // 2, height // 2
+    inout.X_BUF = int(width / buffer_setting)
+    inout.Y_BUF = int(height / buffer_setting)
+    enter, leave = 0, 0
+    movelist = []
+    move_time = 0.0
+    for (area, cx, cy), frame_time in zip(detections, times):
+        if area <= min_area:
+            continue
+        if frame_time - move_time >= timeout:
+            movelist = []
+        move_time = frame_time
+        if inout.CENTER_LINE_VERT:
+            movelist.append(cx)
+            enter, leave, movelist = inout.crossed_x_centerline(enter, leave,
+                                                                movelist)
+        else:
+            movelist.append(cy)
+            enter, leave, movelist = inout.crossed_y_centerline(enter, leave,
+                                                                movelist)
+    return enter, leave
+
+#------------------------------------------------------------------------------
+def pareto(results):
+    """ return results not beaten on both accuracy and cost, best first """
+    best = []
+    for result in sorted(results, key=lambda r: (-r["accuracy"], r["cost"])):
+        if not best or result["cost"] < best[-1]["cost"]:
+            best.append(result)
+    return best
+
+#------------------------------------------------------------------------------
+def number_list(kind):
+    """ argparse type for comma separated numbers """
+    return lambda text: [kind(value) for value in text.split(",")]
+
+#------------------------------------------------------------------------------
+def main():
+    """ Search settings over labeled footage """
+    parser = argparse.ArgumentParser(
+        description="Search inout.py settings over labeled recorded footage")
+    parser.add_argument("labels", help="csv file of video,enter,leave lines")
+    parser.add_argument("--min-area", type=number_list(int),
+                        default=[300, 500, 700, 1000])
+    parser.add_argument("--threshold", type=number_list(int),
+                        default=[15, 25, 35])
+    parser.add_argument("--blur", type=number_list(int), default=[5, 10, 15])
+    parser.add_argument("--buffer", type=number_list(int), default=[4, 6, 8])
+    parser.add_argument("--timeout", type=number_list(float),
+                        default=[0.25, 0.5, 1.0])
+    parser.add_argument("--cache", default="tuner-cache",
+                        help="folder for cached difference frames")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--csv", help="save all results to this csv file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    print("%s %s" % (PROG_NAME, PROG_VER))
+    labels = read_labels(args.labels)
+    if not os.path.isdir(args.cache):
+        os.makedirs(args.cache)
+    pool = multiprocessing.Pool(args.processes)
+
+    # Stage 1 - decode and gray difference frames once per video
+    cached = pool.map(cache_job, [(video, args.cache)
+                                  for video, enter, leave in labels])
+    videos = {}
+    for (video, enter, leave), (diff_path, times, diff_cost) in zip(labels, cached):
+        shape = np.load(diff_path, mmap_mode="r").shape[1:]
+        videos[video] = (diff_path, times, diff_cost, shape, enter, leave)
+    print("Cached %i videos in %s" % (len(videos), args.cache))
+
+    # Stage 2 - blur once per video and blur size, contours per threshold
+    jobs = [(video, videos[video][0], len(videos[video][1]), blur_size,
+             args.threshold) for video in videos for blur_size in args.blur]
+    detected = {}
+    for video, blur_size, by_threshold in pool.imap_unordered(detect_job, jobs):
+        for threshold, value in by_threshold.items():
+            detected[(video, blur_size, threshold)] = value
+    pool.close()
+    pool.join()
+
+    # Stage 3 - replay crossing logic for every remaining candidate
+    results = []
+    for blur_size, threshold, min_area, buffer_setting, timeout in itertools.product(
+            args.blur, args.threshold, args.min_area, args.buffer, args.timeout):
+        error, truth, cost = 0, 0, 0.0
+        for video, (diff_path, times, diff_cost, shape, enter_truth,
+                    leave_truth) in videos.items():
+            detections, detect_cost = detected[(video, blur_size, threshold)]
+            enter, leave = count_crossings(detections, times, shape, min_area,
+                                           buffer_setting, timeout)
+            error += abs(enter - enter_truth) + abs(leave - leave_truth)
+            truth += enter_truth + leave_truth
+            cost += diff_cost + detect_cost
+        results.append({"MIN_AREA": min_area,
+                        "THRESHOLD_SENSITIVITY": threshold,
+                        "BLUR_SIZE": blur_size,
+                        "BUFFER_SETTING": buffer_setting,
+                        "MOVE_LIST_TIMEOUT": timeout,
+                        "accuracy": max(0.0, 1.0 - error / float(max(truth, 1))),
+                        "cost": 1000.0 * cost / len(videos)})
+
+    print("Pareto set of %i candidates (accuracy vs ms per frame)" % len(results))
+    print("%8s %6s %5s %6s %7s %8s %8s" % ("MinArea", "Thresh", "Blur",
+                                           "Buffer", "Timeout", "Accuracy", "ms/Frame"))
+    for result in pareto(results):
+        print("%8i %6i %5i %6i %7.2f %8.3f %8.3f"
+              % (result["MIN_AREA"], result["THRESHOLD_SENSITIVITY"],
+                 result["BLUR_SIZE"], result["BUFFER_SETTING"],
+                 result["MOVE_LIST_TIMEOUT"], result["accuracy"], result["cost"]))
+    if args.csv:
+        keys = ["MIN_AREA", "THRESHOLD_SENSITIVITY", "BLUR_SIZE",
+                "BUFFER_SETTING", "MOVE_LIST_TIMEOUT", "accuracy", "cost"]
+        with open(args.csv, "w") as f:
+            f.write(",".join(keys) + "\n")
+            for result in results:
+                f.write(",".join([str(result[key]) for key in keys]) + "\n")
+        print("Saved %s" % args.csv)
+
+if __name__ == '__main__':
+    main()
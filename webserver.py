@@ -1,7 +1,6 @@
-#!/usr/bin/env python
-import cgi, os, socket, SocketServer, sys, time, urllib
-from SimpleHTTPServer import SimpleHTTPRequestHandler
-from StringIO import StringIO
+#!/usr/bin/env python3
+import html, io, os, socket, socketserver, sys, time, urllib.parse
+from http.server import SimpleHTTPRequestHandler
 
 version = "ver 3.10 written by Claude Pageau"
 
@@ -69,6 +68,33 @@ list_title = "%s %s" % ( dir_sort, dir_order )
 
 class DirectoryHandler(SimpleHTTPRequestHandler):
 
+    def do_GET(self):
+        if self.path == "/events":
+            self.send_events()
+        else:
+            SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_events(self):
+        # Relay inout.py events from its local Unix socket as Server-Sent Events
+        # Each browser gets its own inout.py subscriber so a slow one is dropped
+        try:
+            events = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            events.connect(EVENT_SOCKET_PATH)
+        except (socket.error, AttributeError):
+            self.send_error(503, "inout.py events not available. Set EVENT_SOCKET_ON = True")
+            return
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for line in events.makefile("r"):
+                self.wfile.write(("data: %s\n\n" % line.strip()).encode("utf-8"))
+                self.wfile.flush()
+        except socket.error:
+            pass
+        events.close()
+
     def list_directory(self, path):
         try:
             list = os.listdir(path)
@@ -83,8 +109,8 @@ class DirectoryHandler(SimpleHTTPRequestHandler):
         else:
             # Sort by File Name
             list.sort(key=lambda a: a.lower(),reverse=web_list_sort_descending)
-        f = StringIO()
-        displaypath = cgi.escape(urllib.unquote(self.path))
+        f = io.StringIO()
+        displaypath = html.escape(urllib.parse.unquote(self.path), quote=False)
         # Start HTML formatting code
         f.write('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
         f.write('<head>')
@@ -137,10 +163,10 @@ class DirectoryHandler(SimpleHTTPRequestHandler):
                 displayname = name + "/"
                 linkname = os.path.join(displaypath, displayname)
                 f.write('<li><a href="%s" target="_blank">%s</a></li>\n'
-                          % ( urllib.quote(linkname), cgi.escape(displayname)))
+                          % ( urllib.parse.quote(linkname), html.escape(displayname, quote=False)))
             else:
                 f.write('<li><a href="%s" target="imgbox">%s</a> - %s</li>\n'
-                          % ( urllib.quote(linkname), cgi.escape(displayname), date_modified))
+                          % ( urllib.parse.quote(linkname), html.escape(displayname, quote=False), date_modified))
         f.write('</ul></div><p><b>')
         f.write('<div style="float: left; padding-left: 40px;">Web Root is [ %s ]</div>' % ( web_server_root )) 
         f.write('<div style="text-align: center;">%s</div>' % ( web_page_title ))
@@ -156,19 +182,22 @@ class DirectoryHandler(SimpleHTTPRequestHandler):
                                       % ( all_entries, self.path ))
         # Display web refresh info only if setting is turned on
         f.write('</b></p>')
-        length = f.tell()
-        f.seek(0)
-        self.send_response(200)
         encoding = sys.getfilesystemencoding()
+        page = f.getvalue().encode(encoding, "surrogateescape")
+        self.send_response(200)
         self.send_header("Content-type", "text/html; charset=%s" % encoding)
-        self.send_header("Content-Length", str(length))
+        self.send_header("Content-Length", str(len(page)))
         self.end_headers()
-        return f
+        return io.BytesIO(page)
 
 # Start Web Server Processing        
 os.chdir(web_server_root)
-SocketServer.TCPServer.allow_reuse_address = True
-httpd = SocketServer.TCPServer(("", web_server_port), DirectoryHandler)
+class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # Threaded so an open /events stream does not block file listings
+    allow_reuse_address = True
+    daemon_threads = True
+
+httpd = ThreadedServer(("", web_server_port), DirectoryHandler)
 print("----------------------------------------------------------------")
 print("%s %s" % ( prog_name, version))
 print("---------------------------- Settings --------------------------")
@@ -188,6 +217,8 @@ print("Type the URL below into the browser url bar then hit enter key.")
 print("")
 print("                 http://%s:%i"  % ( myip, web_server_port ))
 print("")
+print("Events  - http://%s:%i/events  (needs inout.py EVENT_SOCKET_ON = True)" % ( myip, web_server_port ))
+print("")
 print("IMPORTANT: If You Get - socket.error: [Errno 98] Address already in use")
 print("           Wait a minute or so for webserver to timeout and Retry.")
 print("              ctrl-c to exit this webserver script")